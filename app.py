@@ -1,12 +1,27 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, g
 import os
 import requests
 import json
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
-import sqlite3
+from storage import create_storage
+from jobs import JobQueue
 import hashlib
+import hmac
+import inspect
 import uuid
+import re
+import math
+import time
+import threading
+import random
+import bisect
+import gc
+import resource
+import tempfile
+import tracemalloc
+from collections import OrderedDict, Counter, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 
 load_dotenv()
@@ -33,26 +48,51 @@ OPENWEATHER_API_KEY = os.getenv('OPENWEATHER_API_KEY')
 # print(f"OpenWeather API key loaded: {'Yes' if OPENWEATHER_API_KEY else 'No'}")
 
 # Database initialization
+# DATABASE_URL selects the backend: sqlite:///path (default) or postgresql://...
+storage = create_storage(os.getenv('DATABASE_URL'))
+
+def utc_timestamp(seconds_ago=0):
+    """UTC timestamp string comparable with CURRENT_TIMESTAMP columns on every backend"""
+    return (datetime.utcnow() - timedelta(seconds=seconds_ago)).strftime('%Y-%m-%d %H:%M:%S')
+
+# Schema migrations, applied in order after the base tables in storage.BASE_SCHEMA.
+# Append new entries; never edit or reorder ones that have shipped.
+SCHEMA_MIGRATIONS = [
+    ['CREATE INDEX IF NOT EXISTS idx_calculations_user_created ON calculations (user_id, created_at)'],
+    ['ALTER TABLE calculations ADD COLUMN region_category TEXT',
+     '''CREATE TABLE IF NOT EXISTS quantile_sketches
+        (name TEXT PRIMARY KEY, sketch TEXT, updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)'''],
+    ['''CREATE TABLE IF NOT EXISTS user_trends
+        (user_id TEXT PRIMARY KEY, calculation_count INTEGER, carbon_sum REAL,
+         transport_sum REAL, food_sum REAL, energy_sum REAL, waste_sum REAL,
+         ewma REAL, last_total REAL, periods TEXT, best_period TEXT, best_period_avg REAL,
+         worst_period TEXT, worst_period_avg REAL, first_period TEXT, updated_at TIMESTAMP)'''],
+    # REAL is 4 bytes on PostgreSQL: rebuild the running sums and totals as DOUBLE PRECISION
+    # (8 bytes on both backends; SQLite has no ALTER COLUMN ... TYPE, so the tables are copied)
+    ['''CREATE TABLE user_trends_new
+        (user_id TEXT PRIMARY KEY, calculation_count INTEGER, carbon_sum DOUBLE PRECISION,
+         transport_sum DOUBLE PRECISION, food_sum DOUBLE PRECISION, energy_sum DOUBLE PRECISION,
+         waste_sum DOUBLE PRECISION, ewma DOUBLE PRECISION, last_total DOUBLE PRECISION, periods TEXT,
+         best_period TEXT, best_period_avg DOUBLE PRECISION, worst_period TEXT,
+         worst_period_avg DOUBLE PRECISION, first_period TEXT, updated_at TIMESTAMP)''',
+     '''INSERT INTO user_trends_new SELECT user_id, calculation_count, carbon_sum, transport_sum, food_sum,
+        energy_sum, waste_sum, ewma, last_total, periods, best_period, best_period_avg, worst_period,
+        worst_period_avg, first_period, updated_at FROM user_trends''',
+     'DROP TABLE user_trends',
+     'ALTER TABLE user_trends_new RENAME TO user_trends',
+     '''CREATE TABLE calculations_new
+        (id TEXT PRIMARY KEY, user_id TEXT, carbon_total DOUBLE PRECISION, breakdown TEXT,
+         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, region_category TEXT)''',
+     '''INSERT INTO calculations_new SELECT id, user_id, carbon_total, breakdown, created_at, region_category
+        FROM calculations''',
+     'DROP TABLE calculations',
+     'ALTER TABLE calculations_new RENAME TO calculations',
+     'CREATE INDEX IF NOT EXISTS idx_calculations_user_created ON calculations (user_id, created_at)'],
+]
+
 def init_db():
-    conn = sqlite3.connect('novelsync.db')
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS users
-                 (id TEXT PRIMARY KEY, email TEXT UNIQUE, password_hash TEXT, 
-                  premium BOOLEAN DEFAULT FALSE, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS calculations
-                 (id TEXT PRIMARY KEY, user_id TEXT, carbon_total REAL, 
-                  breakdown TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS analytics
-                 (id TEXT PRIMARY KEY, event_type TEXT, user_id TEXT, 
-                  data TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS goals
-                 (id TEXT PRIMARY KEY, user_id TEXT, target_carbon REAL,
-                  current_carbon REAL, deadline DATE, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS subscriptions
-                 (id TEXT PRIMARY KEY, user_id TEXT, stripe_subscription_id TEXT,
-                  status TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    conn.commit()
-    conn.close()
+    """Create tables and apply pending migrations; return the schema version"""
+    return storage.migrate(SCHEMA_MIGRATIONS)
 
 # Advanced carbon calculation factors with regional variations
 CARBON_FACTORS = {
@@ -86,6 +126,19 @@ CARBON_FACTORS = {
     }
 }
 
+def build_factor_tables():
+    """Resolve CARBON_FACTORS into per-region lookup tables with global fallbacks"""
+    regions = {region for items in CARBON_FACTORS.values() for factors in items.values() for region in factors}
+    return {
+        region: {
+            category: {item: factors.get(region, factors['global']) for item, factors in items.items()}
+            for category, items in CARBON_FACTORS.items()
+        }
+        for region in regions
+    }
+
+FACTOR_TABLES = build_factor_tables()
+
 def get_region_category(country):
     """Determine region category for carbon factors"""
     europe_countries = ['Germany', 'France', 'UK', 'Italy', 'Spain', 'Netherlands', 'Switzerland', 'Sweden', 'Norway', 'Denmark']
@@ -125,6 +178,7 @@ def get_weather_data(city, country):
 
 def calculate_carbon_footprint(data, region_category='global'):
     """Calculate total carbon footprint with regional factors"""
+    factors = FACTOR_TABLES.get(region_category, FACTOR_TABLES['global'])
     total_co2 = 0
     breakdown = {
         'transport': 0,
@@ -137,8 +191,8 @@ def calculate_carbon_footprint(data, region_category='global'):
     if 'transport_mode' in data and 'transport_distance' in data:
         mode = data['transport_mode']
         distance = float(data['transport_distance'])
-        if mode in CARBON_FACTORS['transport']:
-            factor = CARBON_FACTORS['transport'][mode].get(region_category, CARBON_FACTORS['transport'][mode]['global'])
+        if mode in factors['transport']:
+            factor = factors['transport'][mode]
             co2 = distance * factor
             breakdown['transport'] = co2
             total_co2 += co2
@@ -146,8 +200,8 @@ def calculate_carbon_footprint(data, region_category='global'):
     # Food calculations with regional factors
     if 'food_choices' in data:
         for food in data['food_choices']:
-            if food in CARBON_FACTORS['food']:
-                factor = CARBON_FACTORS['food'][food].get(region_category, CARBON_FACTORS['food'][food]['global'])
+            if food in factors['food']:
+                factor = factors['food'][food]
                 co2 = factor
                 breakdown['food'] += co2
                 total_co2 += co2
@@ -155,7 +209,7 @@ def calculate_carbon_footprint(data, region_category='global'):
     # Energy calculations with regional factors
     if 'energy_kwh' in data:
         kwh = float(data['energy_kwh'])
-        factor = CARBON_FACTORS['energy']['electricity'].get(region_category, CARBON_FACTORS['energy']['electricity']['global'])
+        factor = factors['energy']['electricity']
         co2 = kwh * factor
         breakdown['energy'] = co2
         total_co2 += co2
@@ -164,8 +218,8 @@ def calculate_carbon_footprint(data, region_category='global'):
     if 'waste_type' in data and 'waste_amount' in data:
         waste_type = data['waste_type']
         waste_amount = float(data['waste_amount'])
-        if waste_type in CARBON_FACTORS['waste']:
-            factor = CARBON_FACTORS['waste'][waste_type].get(region_category, CARBON_FACTORS['waste'][waste_type]['global'])
+        if waste_type in factors['waste']:
+            factor = factors['waste'][waste_type]
             co2 = waste_amount * factor
             breakdown['waste'] = co2
             total_co2 += co2
@@ -181,6 +235,249 @@ def calculate_carbon_footprint(data, region_category='global'):
         'region_category': region_category
     }
 
+# Prompt templates are whitespace-minimized before sending to keep input tokens small
+SUGGESTIONS_PROMPT = ("Give 5 specific, actionable suggestions to reduce this user's carbon footprint. {context} "
+                      "Reply with only the suggestions, one per line, no numbering or emojis. "
+                      "Focus on practical, immediate, region-specific and weather-appropriate actions.")
+ECOBOT_SYSTEM_PROMPT = ("You are EcoBot, a sustainability assistant. Give helpful, practical, actionable advice on "
+                        "sustainability, carbon reduction, green living and environmental topics in a "
+                        "conversational tone. {context}")
+
+def compact_whitespace(text):
+    """Collapse runs of whitespace so prompts carry no indentation padding"""
+    return re.sub(r'\s+', ' ', text).strip()
+
+def estimate_tokens(text):
+    """Rough token estimate (~4 characters per token) for prompt budgeting"""
+    return len(text) // 4 + 1
+
+def weather_summary(weather_data):
+    """One-line weather context for prompts"""
+    if not weather_data:
+        return ''
+    return (f"Weather: {weather_data.get('weather', [{}])[0].get('main', 'Unknown')}, "
+            f"{weather_data.get('main', {}).get('temp', 'Unknown')}°C.")
+
+# LLM routing
+# Model, token budget, timeout and latency SLO are chosen per tier and route.
+# slo_ms bounds the whole call: once it is spent call_llm raises and the caller
+# answers locally. When a model's p95 over the last LLM_SLO_WINDOW_SECONDS breaks
+# the SLO, requests go straight to the faster fallback model; premium routes also
+# hedge, starting the fallback model if the primary hasn't answered after
+# hedge_after_ms. LLM_ROUTING_CONFIG (JSON, same shape) overrides individual settings.
+LLM_ROUTES = {
+    'premium': {
+        'calculate': {'model': 'sonar-pro', 'max_tokens': 300, 'timeout': 10, 'slo_ms': 4000,
+                      'fallback_model': 'sonar', 'hedge_after_ms': 2500},
+        'ecobot': {'model': 'sonar-pro', 'max_tokens': 600, 'timeout': 15, 'slo_ms': 6000,
+                   'fallback_model': 'sonar', 'hedge_after_ms': 4000}
+    },
+    'free': {
+        'calculate': {'model': 'sonar', 'max_tokens': 250, 'timeout': 8, 'slo_ms': 6000,
+                      'fallback_model': None, 'hedge_after_ms': None},
+        'ecobot': {'model': 'sonar', 'max_tokens': 400, 'timeout': 12, 'slo_ms': 10000,
+                   'fallback_model': None, 'hedge_after_ms': None}
+    }
+}
+
+def apply_llm_overrides(overrides):
+    """Merge {tier: {route: {setting: value}}} overrides into LLM_ROUTES"""
+    for tier, routes in overrides.items():
+        for route, settings in routes.items():
+            LLM_ROUTES.setdefault(tier, {}).setdefault(route, {}).update(settings)
+
+apply_llm_overrides(json.loads(os.getenv('LLM_ROUTING_CONFIG', '{}')))
+
+# USD per million tokens (input, output)
+LLM_PRICING = {'sonar': (1.0, 1.0), 'sonar-pro': (3.0, 15.0)}
+LLM_PRICING.update({model: tuple(prices) for model, prices in json.loads(os.getenv('LLM_PRICING', '{}')).items()})
+LLM_SLO_MIN_SAMPLES = int(os.getenv('LLM_SLO_MIN_SAMPLES', '20'))
+LLM_SLO_PROBE_RATE = float(os.getenv('LLM_SLO_PROBE_RATE', '0.1'))  # share of degraded requests still sent to the primary
+LLM_SLO_WINDOW_SECONDS = int(os.getenv('LLM_SLO_WINDOW_SECONDS', '300'))  # latency samples older than this are ignored
+
+def llm_tier(is_premium):
+    return 'premium' if is_premium else 'free'
+
+def nearest_rank(sorted_values, fraction):
+    """Nearest-rank percentile of an ascending list (fraction in (0, 1]), None if empty"""
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values), math.ceil(fraction * len(sorted_values))) - 1]
+
+class LLMMetrics:
+    """Per-tier/route/model latency, SLO and cost accounting (per worker)"""
+
+    def __init__(self, window=1000):
+        self.window = window
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def _entry(self, key):
+        return self.series.setdefault(key, {
+            'latencies': deque(maxlen=self.window), 'requests': 0, 'errors': 0,  # (timestamp, latency_ms)
+            'slo_violations': 0, 'hedged': 0, 'degraded': 0, 'cost_usd': 0.0
+        })
+
+    def record(self, tier, route, model, latency_ms, ok, cost=0.0, slo_breached=False, hedged=False, degraded=False):
+        with self.lock:
+            entry = self._entry((tier, route, model))
+            entry['requests'] += 1
+            entry['latencies'].append((time.time(), latency_ms))
+            entry['cost_usd'] += cost
+            entry['errors'] += 0 if ok else 1
+            entry['slo_violations'] += 1 if slo_breached else 0
+            entry['hedged'] += 1 if hedged else 0
+            entry['degraded'] += 1 if degraded else 0
+
+    def _recent(self, samples):
+        # Time-bounded window, so a short latency spike stops counting once it has passed
+        cutoff = time.time() - LLM_SLO_WINDOW_SECONDS
+        return sorted(latency for recorded_at, latency in samples if recorded_at >= cutoff)
+
+    def p95(self, tier, route, model):
+        """p95 latency in ms over the recent window, None until enough recent samples"""
+        with self.lock:
+            latencies = self._recent(self.series.get((tier, route, model), {}).get('latencies', ()))
+        if len(latencies) < LLM_SLO_MIN_SAMPLES:
+            return None
+        return nearest_rank(latencies, 0.95)
+
+    def snapshot(self):
+        with self.lock:
+            result = {}
+            for (tier, route, model), entry in self.series.items():
+                latencies = self._recent(entry['latencies'])
+                result.setdefault(tier, {}).setdefault(route, {})[model] = {
+                    'requests': entry['requests'],
+                    'errors': entry['errors'],
+                    'p50_ms': round(nearest_rank(latencies, 0.5), 1) if latencies else None,
+                    'p95_ms': round(nearest_rank(latencies, 0.95), 1) if latencies else None,
+                    'slo_ms': LLM_ROUTES.get(tier, {}).get(route, {}).get('slo_ms'),
+                    'slo_violations': entry['slo_violations'],
+                    'hedged': entry['hedged'],
+                    'degraded': entry['degraded'],
+                    'cost_usd': round(entry['cost_usd'], 6)
+                }
+            return result
+
+llm_metrics = LLMMetrics()
+_llm_executor = {'pid': None, 'pool': None}
+
+def llm_executor():
+    """Thread pool for LLM attempts, created per process (safe after fork)"""
+    if _llm_executor['pid'] != os.getpid():
+        _llm_executor['pool'] = ThreadPoolExecutor(max_workers=int(os.getenv('LLM_HEDGE_THREADS', '8')))
+        _llm_executor['pid'] = os.getpid()
+    return _llm_executor['pool']
+
+def perplexity_chat(model, messages, max_tokens, timeout, temperature=0.7):
+    """One Perplexity chat completion; returns (content, cost_usd) or raises"""
+    headers = {
+        "Authorization": f"Bearer {PERPLEXITY_API_KEY}",
+        "Content-Type": "application/json"
+    }
+    
+    payload = {
+        "model": model,
+        "messages": messages,
+        "max_tokens": max_tokens,
+        "temperature": temperature
+    }
+    
+    response = requests.post(
+        "https://api.perplexity.ai/chat/completions",
+        headers=headers,
+        json=payload,
+        timeout=timeout
+    )
+    
+    if response.status_code != 200:
+        raise RuntimeError(f"Perplexity API error: {response.status_code} - {response.text}")
+    
+    response_data = response.json()
+    content = response_data['choices'][0]['message']['content'].strip()
+    usage = response_data.get('usage') or {}
+    input_price, output_price = LLM_PRICING.get(model, (0.0, 0.0))
+    prompt_tokens = usage.get('prompt_tokens', sum(estimate_tokens(m['content']) for m in messages))
+    completion_tokens = usage.get('completion_tokens', estimate_tokens(content))
+    return content, (prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000
+
+def call_llm(route, is_premium, messages, temperature=0.7):
+    """Route a chat completion by tier and route; raises if no model answers within the route's SLO"""
+    tier = llm_tier(is_premium)
+    config = LLM_ROUTES[tier][route]
+    primary, fallback = config['model'], config.get('fallback_model')
+    
+    # SLO at risk: the primary's recent p95 is already over budget, so use the faster model
+    # (a small share of requests still probes the primary so it can recover)
+    p95 = llm_metrics.p95(tier, route, primary)
+    degraded = bool(fallback and p95 is not None and p95 > config['slo_ms'] and random.random() >= LLM_SLO_PROBE_RATE)
+    if degraded:
+        primary, fallback = fallback, None
+    
+    started = time.perf_counter()
+    deadline = started + config['slo_ms'] / 1000
+    
+    def attempt(model, hedged=False):
+        attempt_started = time.perf_counter()
+        # The HTTP call never outlives the SLO budget that is left
+        timeout = max(min(config['timeout'], deadline - attempt_started), 0.1)
+        try:
+            content, cost = perplexity_chat(model, messages, config['max_tokens'], timeout, temperature)
+        except Exception:
+            failed = time.perf_counter()
+            llm_metrics.record(tier, route, model, (failed - attempt_started) * 1000, False,
+                               slo_breached=failed >= deadline, hedged=hedged, degraded=degraded)
+            raise
+        # The model's own latency feeds its p95; the SLO is judged on end-to-end latency
+        finished = time.perf_counter()
+        llm_metrics.record(tier, route, model, (finished - attempt_started) * 1000, True, cost,
+                           (finished - started) * 1000 > config['slo_ms'], hedged=hedged, degraded=degraded)
+        return content
+    
+    executor = llm_executor()
+    pending = {executor.submit(attempt, primary)}
+    hedge_after = config.get('hedge_after_ms')
+    hedge_at = started + hedge_after / 1000 if fallback and hedge_after else deadline
+    errors = []
+    while pending:
+        until = hedge_at if fallback else deadline
+        done, pending = wait(pending, timeout=max(until - time.perf_counter(), 0), return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            errors.append(future.exception())
+        if time.perf_counter() >= deadline:
+            break
+        if fallback and (not pending or time.perf_counter() >= hedge_at):
+            # Primary is slow (hedge) or failed: race the fallback model against it
+            pending.add(executor.submit(attempt, fallback, True))
+            fallback = None
+    raise RuntimeError(f"LLM {tier}/{route} got no answer within its {config['slo_ms']} ms SLO: {errors}")
+
+def request_ai_suggestions(user_data, region, weather_data, is_premium=False):
+    """Ask Perplexity for suggestions; raises if every routed model fails or returns too few"""
+    # Build comprehensive context for AI
+    breakdown = user_data['breakdown']
+    context = (f"Location: {region['city']}, {region['country']}. "
+               f"Footprint: {user_data['total']} kg CO2e (transport {round(breakdown['transport'], 2)}, "
+               f"food {round(breakdown['food'], 2)}, energy {round(breakdown['energy'], 2)}, "
+               f"waste {round(breakdown['waste'], 2)}). "
+               f"Region category: {user_data.get('region_category', 'global')}. ")
+    context += weather_summary(weather_data)
+
+    prompt = compact_whitespace(SUGGESTIONS_PROMPT.format(context=context))
+    
+    # Routed by tier: model, token budget and latency SLO come from LLM_ROUTES
+    content = call_llm('calculate', is_premium, [{"role": "user", "content": prompt}])
+    suggestions = [s.strip() for s in content.split('\n') if s.strip()]
+    
+    # Ensure we have at least 3 suggestions
+    if len(suggestions) < 3:
+        raise RuntimeError(f"Not enough AI suggestions: {len(suggestions)}")
+    
+    return suggestions[:5]  # Return max 5 suggestions
+
 def generate_eco_suggestions(user_data, region, weather_data, is_premium=False):
     """Generate advanced AI-powered eco suggestions using Perplexity Sonar Pro"""
     try:
@@ -188,165 +485,330 @@ def generate_eco_suggestions(user_data, region, weather_data, is_premium=False):
             # print("Perplexity API key not found, using fallback suggestions")
             return get_fallback_suggestions(user_data)
         
-        # Build comprehensive context for AI
-        context = f"""
-        User location: {region['city']}, {region['country']}
-        Carbon footprint: {user_data['total']} kg CO2e
-        Breakdown: Transport: {user_data['breakdown']['transport']}, Food: {user_data['breakdown']['food']}, Energy: {user_data['breakdown']['energy']}, Waste: {user_data['breakdown']['waste']}
-        Region category: {user_data.get('region_category', 'global')}
-        """
-        
-        if weather_data:
-            context += f"Weather: {weather_data.get('weather', [{}])[0].get('main', 'Unknown')}, Temperature: {weather_data.get('main', {}).get('temp', 'Unknown')}°C"
-        
-        prompt = f"""
-        Based on this user data, provide 5 specific, actionable suggestions to reduce their carbon footprint:
-        {context}
-        
-        Provide only the suggestions, one per line, without numbering or emojis. Focus on practical, immediate actions that are region-specific and weather-appropriate.
-        """
-        
-        # Perplexity API call
-        headers = {
-            "Authorization": f"Bearer {PERPLEXITY_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        
-        payload = {
-            "model": "sonar-pro",
-            "messages": [
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ],
-            "max_tokens": 250,
-            "temperature": 0.7
-        }
-        
-        response = requests.post(
-            "https://api.perplexity.ai/chat/completions",
-            headers=headers,
-            json=payload
-        )
-        
-        if response.status_code == 200:
-            response_data = response.json()
-            suggestions = response_data['choices'][0]['message']['content'].strip().split('\n')
-            suggestions = [s.strip() for s in suggestions if s.strip()]
-            
-            # print(f"AI suggestions generated: {len(suggestions)} suggestions")
-            
-            # Ensure we have at least 3 suggestions
-            if len(suggestions) < 3:
-                # print("Not enough AI suggestions, using fallback")
-                return get_fallback_suggestions(user_data)
-            
-            return suggestions[:5]  # Return max 5 suggestions
-        else:
-            print(f"Perplexity API error: {response.status_code} - {response.text}")
-            return get_fallback_suggestions(user_data)
+        return request_ai_suggestions(user_data, region, weather_data, is_premium)
         
     except Exception as e:
         print(f"AI suggestions error: {str(e)}")
         return get_fallback_suggestions(user_data)
 
-def get_fallback_suggestions(user_data):
-    """Enhanced fallback suggestions with comprehensive coverage"""
-    # print("Using fallback suggestions")
-    suggestions = []
-    
-    # Transport suggestions
-    if user_data['breakdown']['transport'] > 0:
-        suggestions.extend([
-            "Consider using public transportation or carpooling for your daily commute",
-            "Explore electric vehicle options for your next car purchase",
-            "Try walking or cycling for short trips under 2 miles",
-            "Plan your errands to minimize multiple trips",
-            "Consider telecommuting options to reduce commute emissions"
-        ])
-    
-    # Food suggestions
-    if user_data['breakdown']['food'] > 0:
-        suggestions.extend([
-            "Try incorporating more plant-based meals into your diet",
-            "Support local farmers and reduce food transportation emissions",
-            "Reduce food waste by planning meals and using leftovers",
-            "Choose seasonal and organic produce when possible",
-            "Consider growing your own herbs and vegetables"
-        ])
-    
-    # Energy suggestions
-    if user_data['breakdown']['energy'] > 0:
-        suggestions.extend([
-            "Switch to energy-efficient appliances and turn off unused electronics",
-            "Consider installing solar panels or switching to renewable energy",
-            "Use LED light bulbs and natural lighting when possible",
-            "Adjust your thermostat to reduce heating and cooling costs",
-            "Unplug chargers and devices when not in use"
-        ])
-    
-    # Waste suggestions
-    if user_data['breakdown']['waste'] > 0:
-        suggestions.extend([
-            "Start composting organic waste and reduce single-use plastics",
-            "Implement a zero-waste lifestyle with reusable containers",
-            "Recycle paper, glass, and metal products properly",
-            "Choose products with minimal packaging",
-            "Repair items instead of replacing them when possible"
-        ])
-    
-    # General lifestyle suggestions
-    suggestions.extend([
+# Fallback suggestion catalog, by footprint category, in priority order
+SUGGESTION_CATALOG = {
+    'transport': (
+        "Consider using public transportation or carpooling for your daily commute",
+        "Explore electric vehicle options for your next car purchase",
+        "Try walking or cycling for short trips under 2 miles",
+        "Plan your errands to minimize multiple trips",
+        "Consider telecommuting options to reduce commute emissions"
+    ),
+    'food': (
+        "Try incorporating more plant-based meals into your diet",
+        "Support local farmers and reduce food transportation emissions",
+        "Reduce food waste by planning meals and using leftovers",
+        "Choose seasonal and organic produce when possible",
+        "Consider growing your own herbs and vegetables"
+    ),
+    'energy': (
+        "Switch to energy-efficient appliances and turn off unused electronics",
+        "Consider installing solar panels or switching to renewable energy",
+        "Use LED light bulbs and natural lighting when possible",
+        "Adjust your thermostat to reduce heating and cooling costs",
+        "Unplug chargers and devices when not in use"
+    ),
+    'waste': (
+        "Start composting organic waste and reduce single-use plastics",
+        "Implement a zero-waste lifestyle with reusable containers",
+        "Recycle paper, glass, and metal products properly",
+        "Choose products with minimal packaging",
+        "Repair items instead of replacing them when possible"
+    ),
+    'general': (
         "Support businesses that prioritize sustainability and environmental responsibility",
         "Educate yourself and others about climate change and its local impacts",
         "Participate in local environmental initiatives and community clean-up events",
         "Consider carbon offset programs for unavoidable emissions from essential activities",
         "Track your progress and set monthly reduction goals to maintain motivation"
-    ])
-    
-    # Return unique suggestions, prioritizing based on user's highest impact areas
-    unique_suggestions = list(dict.fromkeys(suggestions))  # Remove duplicates while preserving order
-    
-    # Prioritize suggestions based on user's highest impact areas
-    impact_areas = [
-        ('transport', user_data['breakdown']['transport']),
-        ('food', user_data['breakdown']['food']),
-        ('energy', user_data['breakdown']['energy']),
-        ('waste', user_data['breakdown']['waste'])
-    ]
-    impact_areas.sort(key=lambda x: x[1], reverse=True)
-    
-    # Return 5-7 most relevant suggestions
-    return unique_suggestions[:7]
+    )
+}
+SUGGESTION_CATEGORIES = ('transport', 'food', 'energy', 'waste')
+
+def build_fallback_suggestions():
+    """Precompute the fallback list for every combination of active footprint categories"""
+    combinations = {}
+    for mask in range(1 << len(SUGGESTION_CATEGORIES)):
+        active = tuple(bool(mask & (1 << i)) for i in range(len(SUGGESTION_CATEGORIES)))
+        suggestions = [s for category, on in zip(SUGGESTION_CATEGORIES, active) if on
+                       for s in SUGGESTION_CATALOG[category]]
+        suggestions.extend(SUGGESTION_CATALOG['general'])
+        # Remove duplicates while preserving order and return the 5-7 most relevant suggestions
+        combinations[active] = tuple(dict.fromkeys(suggestions))[:7]
+    return combinations
+
+FALLBACK_SUGGESTIONS = build_fallback_suggestions()
+
+def get_fallback_suggestions(user_data):
+    """Enhanced fallback suggestions with comprehensive coverage"""
+    active = tuple(user_data['breakdown'][category] > 0 for category in SUGGESTION_CATEGORIES)
+    return list(FALLBACK_SUGGESTIONS[active])
 
 def track_analytics(event_type, user_id=None, data=None):
     """Track user analytics"""
     try:
-        conn = sqlite3.connect('novelsync.db')
-        c = conn.cursor()
-        c.execute('''INSERT INTO analytics (id, event_type, user_id, data) 
-                     VALUES (?, ?, ?, ?)''', 
-                  (str(uuid.uuid4()), event_type, user_id, json.dumps(data) if data else None))
-        conn.commit()
-        conn.close()
+        storage.record_event((str(uuid.uuid4()), event_type, user_id, json.dumps(data) if data else None))
     except Exception as e:
         print(f"Analytics tracking error: {str(e)}")
 
+# Footprint percentile ranking
+# Every stored calculation feeds a KLL quantile sketch (overall, per region
+# category and per breakdown category). Workers buffer new values in a local
+# delta sketch and merge it into the persisted sketches every
+# SKETCH_SYNC_INTERVAL seconds, so ranking never scans the calculations table.
+SKETCH_K = 200
+SKETCH_SYNC_INTERVAL = int(os.getenv('SKETCH_SYNC_INTERVAL', '60'))  # seconds
+SKETCH_MIN_SAMPLES = int(os.getenv('SKETCH_MIN_SAMPLES', '20'))
+
+class QuantileSketch:
+    """Mergeable KLL quantile sketch over floats"""
+
+    def __init__(self, k=SKETCH_K):
+        self.k = k
+        self.n = 0
+        self.levels = [[]]
+        self._cdf = None
+
+    def _capacity(self, level):
+        return max(2, int(math.ceil(self.k * (2 / 3) ** (len(self.levels) - level - 1))))
+
+    def _compress(self):
+        while sum(len(items) for items in self.levels) > sum(self._capacity(h) for h in range(len(self.levels))):
+            for level, items in enumerate(self.levels):
+                if len(items) >= self._capacity(level):
+                    if level + 1 == len(self.levels):
+                        self.levels.append([])
+                    items.sort()
+                    # Keep one item back when the buffer is odd so weights stay exact
+                    keep = [items.pop()] if len(items) % 2 else []
+                    self.levels[level + 1].extend(items[random.getrandbits(1)::2])
+                    self.levels[level] = keep
+                    break
+
+    def update(self, value):
+        self.levels[0].append(float(value))
+        self.n += 1
+        self._cdf = None
+        self._compress()
+
+    def merge(self, other):
+        while len(self.levels) < len(other.levels):
+            self.levels.append([])
+        for level, items in enumerate(other.levels):
+            self.levels[level].extend(items)
+        self.n += other.n
+        self._cdf = None
+        self._compress()
+        return self
+
+    def rank(self, value):
+        """Approximate mid-rank of value: weight below it plus half the weight equal to it"""
+        if self._cdf is None:
+            weighted = sorted((v, 1 << level) for level, items in enumerate(self.levels) for v in items)
+            values, cumulative, total = [], [], 0
+            for v, weight in weighted:
+                total += weight
+                values.append(v)
+                cumulative.append(total)
+            self._cdf = (values, cumulative)
+        values, cumulative = self._cdf
+        below = bisect.bisect_left(values, value)
+        at_or_below = bisect.bisect_right(values, value)
+        weight_below = cumulative[below - 1] if below else 0
+        weight_at_or_below = cumulative[at_or_below - 1] if at_or_below else 0
+        # Splitting ties keeps a common value (e.g. zero in a category) from ranking as 100
+        return weight_below + (weight_at_or_below - weight_below) / 2
+
+    def to_dict(self):
+        return {'k': self.k, 'n': self.n, 'levels': [[round(v, 4) for v in items] for items in self.levels]}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data.get('k', SKETCH_K))
+        sketch.n = data['n']
+        sketch.levels = [list(items) for items in data['levels']] or [[]]
+        return sketch
+
+def sketch_values(carbon_data):
+    """Map a calculation to the (sketch name, value) pairs it contributes"""
+    values = [('total', carbon_data['total'])]
+    values.append((f"region:{carbon_data.get('region_category', 'global')}", carbon_data['total']))
+    values.extend((f"category:{category}", carbon_data['breakdown'][category]) for category in SUGGESTION_CATEGORIES)
+    return values
+
+class PercentileRanker:
+    """Per-worker view of the persisted sketches plus a delta of local inserts"""
+
+    def __init__(self):
+        self.snapshot = {}
+        self.pending = {}
+        self.last_sync = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, carbon_data):
+        with self.lock:
+            for name, value in sketch_values(carbon_data):
+                self.pending.setdefault(name, QuantileSketch()).update(value)
+        self.maybe_sync()
+
+    def percentile(self, name, value):
+        """Mid-rank percentage of stored calculations below value, None until enough samples"""
+        self.maybe_sync()
+        with self.lock:
+            count = weight = 0
+            for sketches in (self.snapshot, self.pending):
+                sketch = sketches.get(name)
+                if sketch is not None:
+                    count += sketch.n
+                    weight += sketch.rank(value)
+        if count < SKETCH_MIN_SAMPLES:
+            return None
+        return round(100 * weight / count, 1)
+
+    def maybe_sync(self):
+        if time.time() - self.last_sync >= SKETCH_SYNC_INTERVAL:
+            self.sync()
+
+    def sync(self):
+        """Merge local deltas into the persisted sketches and refresh the snapshot"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.last_sync = time.time()
+        try:
+            with storage.transaction(lock='quantile_sketches') as tx:
+                tx.execute('SELECT name, sketch FROM quantile_sketches')
+                merged = {name: QuantileSketch.from_dict(json.loads(data)) for name, data in tx.fetchall()}
+                for name, sketch in pending.items():
+                    merged[name] = merged[name].merge(sketch) if name in merged else sketch
+                    storage.upsert(tx, 'quantile_sketches', ('name',), {
+                        'name': name,
+                        'sketch': json.dumps(merged[name].to_dict()),
+                        'updated_at': utc_timestamp()
+                    })
+            with self.lock:
+                self.snapshot = merged
+        except Exception as e:
+            print(f"Sketch sync error: {str(e)}")
+            # Keep the unsynced values for the next attempt
+            with self.lock:
+                for name, sketch in pending.items():
+                    self.pending[name] = sketch.merge(self.pending[name]) if name in self.pending else sketch
+
+def rebuild_quantile_sketches():
+    """Rebuild the persisted sketches from every stored calculation"""
+    sketches = {}
+    with storage.transaction(lock='quantile_sketches') as tx:
+        rows = tx.execute('SELECT carbon_total, breakdown, region_category FROM calculations').fetchall()
+        for carbon_total, breakdown, region_category in rows:
+            breakdown = json.loads(breakdown)
+            carbon_data = {
+                'total': carbon_total,
+                'breakdown': {category: breakdown.get(category, 0) for category in SUGGESTION_CATEGORIES},
+                'region_category': region_category or 'global'
+            }
+            for name, value in sketch_values(carbon_data):
+                sketches.setdefault(name, QuantileSketch()).update(value)
+        tx.execute('DELETE FROM quantile_sketches')
+        storage.insert_many(tx, 'quantile_sketches', ('name', 'sketch'),
+                            [(name, json.dumps(sketch.to_dict())) for name, sketch in sketches.items()])
+    return sketches['total'].n if 'total' in sketches else 0
+
+percentile_ranker = PercentileRanker()
+
+# Per-user trend summaries
+# save_calculation keeps one user_trends row per user up to date, so trends are
+# a single-row lookup instead of a scan over the user's calculations.
+TREND_EWMA_ALPHA = float(os.getenv('TREND_EWMA_ALPHA', '0.3'))
+TREND_COLUMNS = ('calculation_count', 'carbon_sum', 'transport_sum', 'food_sum', 'energy_sum', 'waste_sum',
+                 'ewma', 'last_total', 'periods', 'best_period', 'best_period_avg',
+                 'worst_period', 'worst_period_avg', 'first_period')
+
+def advance_trend(trend, carbon_total, breakdown, period):
+    """Fold one calculation (in a 'YYYY-MM' period) into a trend summary dict"""
+    if trend is None:
+        trend = dict.fromkeys(TREND_COLUMNS)
+        trend.update({'calculation_count': 0, 'carbon_sum': 0.0, 'periods': {}, 'first_period': period})
+        for category in SUGGESTION_CATEGORIES:
+            trend[f'{category}_sum'] = 0.0
+    trend['calculation_count'] += 1
+    trend['carbon_sum'] += carbon_total
+    for category in SUGGESTION_CATEGORIES:
+        trend[f'{category}_sum'] += breakdown.get(category, 0)
+    previous = trend['ewma']
+    trend['ewma'] = carbon_total if previous is None else TREND_EWMA_ALPHA * carbon_total + (1 - TREND_EWMA_ALPHA) * previous
+    trend['last_total'] = carbon_total
+    
+    # Monthly [sum, count]; best/worst periods are ranked by average footprint
+    period_sum, period_count = trend['periods'].get(period, (0.0, 0))
+    trend['periods'][period] = (period_sum + carbon_total, period_count + 1)
+    averages = {p: total / count for p, (total, count) in trend['periods'].items()}
+    trend['best_period'] = min(averages, key=averages.get)
+    trend['worst_period'] = max(averages, key=averages.get)
+    trend['best_period_avg'] = averages[trend['best_period']]
+    trend['worst_period_avg'] = averages[trend['worst_period']]
+    return trend
+
+def load_trend_row(row):
+    """Convert a user_trends row (in TREND_COLUMNS order) into a trend dict"""
+    trend = dict(zip(TREND_COLUMNS, row))
+    trend['periods'] = {p: tuple(v) for p, v in json.loads(trend['periods']).items()}
+    return trend
+
+def store_trend(tx, user_id, trend):
+    """Upsert a trend summary inside an open transaction"""
+    row = {'user_id': user_id}
+    row.update((col, json.dumps(trend[col]) if col == 'periods' else trend[col]) for col in TREND_COLUMNS)
+    row['updated_at'] = utc_timestamp()
+    storage.upsert(tx, 'user_trends', ('user_id',), row)
+
+def update_user_trend(tx, user_id, carbon_data, period):
+    """Read-modify-write the user's trend summary inside the caller's transaction"""
+    tx.execute(f'SELECT {", ".join(TREND_COLUMNS)} FROM user_trends WHERE user_id = ?{storage.for_update}', (user_id,))
+    row = tx.fetchone()
+    trend = advance_trend(load_trend_row(row) if row else None, carbon_data['total'], carbon_data['breakdown'], period)
+    store_trend(tx, user_id, trend)
+
+def rebuild_user_trends():
+    """Backfill every user's trend summary from stored calculations"""
+    trends = {}
+    # Exclusive over the shared lock every save_calculation takes, so no save lands mid-rebuild
+    with storage.transaction(lock='user_trends') as tx:
+        tx.execute('''SELECT user_id, carbon_total, breakdown, created_at FROM calculations
+                      WHERE user_id IS NOT NULL ORDER BY user_id, created_at, id''')
+        for user_id, carbon_total, breakdown, created_at in tx.fetchall():
+            trends[user_id] = advance_trend(trends.get(user_id), carbon_total, json.loads(breakdown), str(created_at)[:7])
+        tx.execute('DELETE FROM user_trends')
+        for user_id, trend in trends.items():
+            store_trend(tx, user_id, trend)
+    return len(trends)
+
 def save_calculation(user_id, carbon_data):
     """Save calculation to database"""
     try:
-        conn = sqlite3.connect('novelsync.db')
-        c = conn.cursor()
-        c.execute('''INSERT INTO calculations (id, user_id, carbon_total, breakdown) 
-                     VALUES (?, ?, ?, ?)''', 
-                  (str(uuid.uuid4()), user_id, carbon_data['total'], json.dumps(carbon_data['breakdown'])))
-        conn.commit()
-        conn.close()
+        # Per-user lock: an advisory lock on PostgreSQL (FOR UPDATE alone can't lock a
+        # trend row that doesn't exist yet), the database write lock on SQLite. The shared
+        # 'user_trends' lock keeps saves out while rebuild_user_trends holds it exclusively.
+        with storage.transaction(lock=f'user_trend:{user_id}', shared_lock='user_trends') as tx:
+            tx.execute('''INSERT INTO calculations (id, user_id, carbon_total, breakdown, region_category) 
+                          VALUES (?, ?, ?, ?, ?)''', 
+                       (str(uuid.uuid4()), user_id, carbon_data['total'], json.dumps(carbon_data['breakdown']),
+                        carbon_data.get('region_category', 'global')))
+            update_user_trend(tx, user_id, carbon_data, datetime.utcnow().strftime('%Y-%m'))
+        percentile_ranker.record(carbon_data)
     except Exception as e:
         print(f"Save calculation error: {str(e)}")
 
-def calculate_environmental_impact(carbon_total):
+def format_percentile(percentile):
+    """Human-readable rank for a footprint percentile; lower footprints are better"""
+    return f"Greener than {int(round(100 - percentile))}% of calculated footprints"
+
+def calculate_environmental_impact(carbon_total, region_category=None, breakdown=None):
     """Calculate comprehensive environmental impact metrics"""
     try:
         # Updated constants based on recent scientific research
@@ -382,6 +844,20 @@ def calculate_environmental_impact(carbon_total):
             # Calculate time to offset with more accurate formula
             years_to_offset = carbon_tons * 1.8  # improved estimate based on natural processes
             
+            # Rank against all stored calculations
+            percentiles = {
+                'overall': percentile_ranker.percentile('total', carbon_total),
+                'region': percentile_ranker.percentile(f"region:{region_category}", carbon_total) if region_category else None,
+                'categories': {
+                    category: percentile_ranker.percentile(f"category:{category}", value)
+                    for category, value in (breakdown or {}).items()
+                }
+            }
+            if percentiles['overall'] is not None:
+                global_rank = format_percentile(percentiles['overall'])
+            else:
+                global_rank = "Below average" if carbon_tons < GLOBAL_AVERAGE_CO2_PER_PERSON else "Above average"
+            
             return {
                 'carbon_tons': round(carbon_tons, 3),
                 'earths_needed': round(earths_needed, 3),
@@ -391,7 +867,8 @@ def calculate_environmental_impact(carbon_total):
                 'impact_level': impact_level,
                 'impact_color': impact_color,
                 'years_to_offset': round(years_to_offset, 1),
-                'global_rank': "Above average" if carbon_tons < GLOBAL_AVERAGE_CO2_PER_PERSON else "Below average"
+                'global_rank': global_rank,
+                'percentiles': percentiles
             }
         
         return None
@@ -399,6 +876,261 @@ def calculate_environmental_impact(carbon_total):
         print(f"Environmental impact calculation error: {str(e)}")
         return None
 
+# EcoBot answer cache
+# Most EcoBot traffic is the same few dozen FAQ-style questions, so answers are
+# cached per worker and looked up by TF-IDF similarity over normalized questions.
+ECOBOT_CACHE_THRESHOLD = float(os.getenv('ECOBOT_CACHE_THRESHOLD', '0.82'))
+ECOBOT_CACHE_TTL = int(os.getenv('ECOBOT_CACHE_TTL', '86400'))  # seconds
+ECOBOT_CACHE_SIZE = int(os.getenv('ECOBOT_CACHE_SIZE', '512'))
+
+# Negations and direction/quantity words (no, more, up, before, ...) are kept:
+# they change what a question asks, so they must change its cache key
+STOPWORDS = frozenset("""
+    a about again all am an and any are as at be because been being between both but by
+    can could did do does doing during each for from further had has have having he her
+    here hers him his how i if in into is it its itself just me my myself of on once or
+    other our ours own please same she should so some such tell than that the their
+    theirs them then there these they this those through to until very was we were what
+    when where which while who whom why will with would you your yours
+""".split())
+
+def stem_word(word):
+    """Light suffix-stripping stemmer (plural and common verb/adjective endings)"""
+    for suffix, replacement in (('ies', 'y'), ('ing', ''), ('ed', ''), ('ly', ''), ('es', ''), ('s', '')):
+        if word.endswith(suffix) and len(word) - len(suffix) >= (2 if suffix == 's' else 3):
+            if suffix == 's' and word.endswith(('ss', 'us')):
+                break
+            word = word[:-len(suffix)] + replacement
+            break
+    # Drop a trailing 'e' so "reduce" matches "reduces", "reducing" and "reduced" (all "reduc")
+    if word.endswith('e') and len(word) > 3:
+        word = word[:-1]
+    return word
+
+def normalize_question(text):
+    """Lowercase, strip punctuation and stopwords, and stem a question into tokens"""
+    words = re.findall(r"[a-z0-9]+", text.lower())
+    return [stem_word(w) for w in words if w not in STOPWORDS]
+
+def question_terms(tokens):
+    """Unigram and bigram term counts used by the similarity index"""
+    terms = Counter(tokens)
+    terms.update(f"{a} {b}" for a, b in zip(tokens, tokens[1:]))
+    return terms
+
+class AnswerCache:
+    """Size-bounded, TTL-expiring answer cache with a TF-IDF near-duplicate index"""
+
+    def __init__(self, threshold=ECOBOT_CACHE_THRESHOLD, ttl=ECOBOT_CACHE_TTL, max_size=ECOBOT_CACHE_SIZE):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()  # normalized key -> (terms, answer, stored_at)
+        self.postings = {}  # term -> set of normalized keys
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def _remove(self, key):
+        terms, _, _ = self.entries.pop(key)
+        for term in terms:
+            keys = self.postings.get(term)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.postings[term]
+
+    def _weights(self, terms):
+        total = len(self.entries)
+        return {t: c * (math.log((1 + total) / (1 + len(self.postings.get(t, ())))) + 1)
+                for t, c in terms.items()}
+
+    def _similarity(self, query_weights, query_norm, terms):
+        weights = self._weights(terms)
+        norm = math.sqrt(sum(w * w for w in weights.values()))
+        if not norm or not query_norm:
+            return 0.0
+        dot = sum(w * weights.get(t, 0.0) for t, w in query_weights.items())
+        return dot / (query_norm * norm)
+
+    def get(self, question):
+        """Return a cached answer for the question or a near-duplicate, else None"""
+        tokens = normalize_question(question)
+        if not tokens:
+            return None
+        key = ' '.join(tokens)
+        now = time.time()
+        with self.lock:
+            match = key if key in self.entries else None
+            if match is None:
+                terms = question_terms(tokens)
+                query_weights = self._weights(terms)
+                query_norm = math.sqrt(sum(w * w for w in query_weights.values()))
+                candidates = set()
+                for term in terms:
+                    candidates.update(self.postings.get(term, ()))
+                best_score = self.threshold
+                for candidate in candidates:
+                    score = self._similarity(query_weights, query_norm, self.entries[candidate][0])
+                    if score >= best_score:
+                        match, best_score = candidate, score
+            if match is not None and now - self.entries[match][2] > self.ttl:
+                self._remove(match)
+                match = None
+            if match is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(match)
+            self.hits += 1
+            return self.entries[match][1]
+
+    def put(self, question, answer):
+        """Store an answer, evicting the least recently used entries past max_size"""
+        tokens = normalize_question(question)
+        if not tokens:
+            return
+        key = ' '.join(tokens)
+        terms = question_terms(tokens)
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (terms, answer, time.time())
+            for term in terms:
+                self.postings.setdefault(term, set()).add(key)
+            while len(self.entries) > self.max_size:
+                self._remove(next(iter(self.entries)))
+
+    def stats(self):
+        """Hit/miss counters and hit rate for metrics export"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+# One cache per LLM tier, so free users never receive answers generated by the premium model
+ecobot_answer_caches = {tier: AnswerCache() for tier in LLM_ROUTES}
+
+# EcoBot conversation state
+# Each session keeps its recent turns verbatim; older turns are compacted into a
+# rolling extractive summary so every upstream prompt stays within a fixed budget.
+ECOBOT_HISTORY_TOKEN_BUDGET = int(os.getenv('ECOBOT_HISTORY_TOKEN_BUDGET', '600'))
+ECOBOT_SUMMARY_TOKEN_BUDGET = int(os.getenv('ECOBOT_SUMMARY_TOKEN_BUDGET', '150'))
+ECOBOT_TURN_TOKEN_LIMIT = int(os.getenv('ECOBOT_TURN_TOKEN_LIMIT', '200'))
+ECOBOT_CONVERSATION_TTL = int(os.getenv('ECOBOT_CONVERSATION_TTL', '86400'))  # seconds
+
+def clip_text(text, max_tokens):
+    """Clip text to roughly max_tokens, preferring a sentence boundary"""
+    text = compact_whitespace(text)
+    max_chars = max_tokens * 4
+    if len(text) <= max_chars:
+        return text
+    clipped = text[:max_chars]
+    boundary = clipped.rfind('. ')
+    return clipped[:boundary + 1] if boundary > max_chars // 2 else clipped.rstrip() + '...'
+
+def summarize_turn(user_turn, assistant_turn):
+    """Extractive one-line summary of a question/answer pair"""
+    first_sentence = re.split(r'(?<=[.!?])\s', compact_whitespace(assistant_turn['content']), maxsplit=1)[0]
+    return f"Q: {clip_text(user_turn['content'], 30)} A: {clip_text(first_sentence, 40)}"
+
+def compact_conversation(summary, turns):
+    """Fold the oldest turns into the summary until the history fits the token budget"""
+    turns = list(turns)
+    while len(turns) > 2 and sum(estimate_tokens(t['content']) for t in turns) > ECOBOT_HISTORY_TOKEN_BUDGET - estimate_tokens(summary):
+        user_turn, assistant_turn = turns.pop(0), turns.pop(0)
+        exchange = summarize_turn(user_turn, assistant_turn)
+        summary = f"{summary} | {exchange}" if summary else exchange
+        # Drop the oldest summarized exchanges once the summary itself is over budget
+        while estimate_tokens(summary) > ECOBOT_SUMMARY_TOKEN_BUDGET and ' | ' in summary:
+            summary = summary.split(' | ', 1)[1]
+        summary = clip_text(summary, ECOBOT_SUMMARY_TOKEN_BUDGET)
+    return summary, turns
+
+def load_conversation(conversation_id):
+    """Load (summary, turns) for a conversation, empty if unknown or expired"""
+    try:
+        with storage.transaction() as c:
+            c.execute('''SELECT summary, turns FROM conversations
+                         WHERE id = ? AND updated_at >= ?''',
+                      (conversation_id, utc_timestamp(ECOBOT_CONVERSATION_TTL)))
+            row = c.fetchone()
+        if row:
+            return row[0] or '', json.loads(row[1] or '[]')
+    except Exception as e:
+        print(f"Load conversation error: {str(e)}")
+    return '', []
+
+def save_conversation(conversation_id, summary, turns):
+    """Persist conversation state and expire stale conversations"""
+    try:
+        with storage.transaction() as c:
+            storage.upsert(c, 'conversations', ('id',), {
+                'id': conversation_id,
+                'summary': summary,
+                'turns': json.dumps(turns),
+                'updated_at': utc_timestamp()
+            })
+            c.execute('DELETE FROM conversations WHERE updated_at < ?', (utc_timestamp(ECOBOT_CONVERSATION_TTL),))
+    except Exception as e:
+        print(f"Save conversation error: {str(e)}")
+
+def build_ecobot_messages(summary, turns, user_message, context):
+    """Assemble chat messages: system prompt with rolling summary, recent turns, new question"""
+    system_prompt = ECOBOT_SYSTEM_PROMPT.format(context=context)
+    if summary:
+        system_prompt += f" Earlier in this conversation: {summary}"
+    messages = [{'role': 'system', 'content': compact_whitespace(system_prompt)}]
+    messages.extend({'role': t['role'], 'content': t['content']} for t in turns)
+    messages.append({'role': 'user', 'content': user_message})
+    return messages
+
+def record_ecobot_turn(conversation_id, summary, turns, user_message, response):
+    """Append a question/answer pair to the conversation and compact it"""
+    turns = turns + [
+        {'role': 'user', 'content': clip_text(user_message, ECOBOT_TURN_TOKEN_LIMIT)},
+        {'role': 'assistant', 'content': clip_text(response, ECOBOT_TURN_TOKEN_LIMIT)}
+    ]
+    summary, turns = compact_conversation(summary, turns)
+    save_conversation(conversation_id, summary, turns)
+
+# Deferred AI suggestions
+# In deferred mode /api/calculate answers with fallback suggestions and a job id;
+# the AI suggestions are produced by the local job queue and fetched from
+# /api/suggestions/<job_id>, so the response time doesn't depend on the LLM.
+DEFER_AI_SUGGESTIONS = os.getenv('DEFER_AI_SUGGESTIONS', 'false').lower() == 'true'
+# ?wait=N long-polls hold a whole sync worker; the web UI short-polls (wait=0) with backoff
+SUGGESTIONS_MAX_WAIT = float(os.getenv('SUGGESTIONS_MAX_WAIT', '10'))  # seconds; keep below the gunicorn timeout
+
+job_queue = JobQueue(
+    path=os.getenv('JOB_QUEUE_PATH', 'novelsync_jobs.db'),
+    workers=int(os.getenv('JOB_QUEUE_WORKERS', '2')),
+    max_attempts=int(os.getenv('JOB_MAX_ATTEMPTS', '3'))
+)
+
+def run_suggestions_job(payload):
+    """Job handler: AI suggestions for a stored calculation (raises to trigger a retry)"""
+    if not PERPLEXITY_API_KEY:
+        return get_fallback_suggestions(payload['carbon_footprint'])
+    return request_ai_suggestions(payload['carbon_footprint'], payload['region'],
+                                  payload['weather'], payload['is_premium'])
+
+job_queue.register('eco_suggestions', run_suggestions_job)
+
+def enqueue_suggestions(carbon_footprint, region, weather_data, is_premium):
+    """Queue AI suggestions; identical footprints in the same conditions share one job"""
+    dedup_key = json.dumps([carbon_footprint['breakdown'], carbon_footprint.get('region_category'), region,
+                            weather_summary(weather_data), is_premium], sort_keys=True)
+    return job_queue.enqueue('eco_suggestions', {
+        'carbon_footprint': carbon_footprint,
+        'region': region,
+        'weather': weather_data,
+        'is_premium': is_premium
+    }, dedup_key=dedup_key)
+
 @app.route('/')
 def index():
     """Main application page"""
@@ -537,7 +1269,7 @@ def calculate():
         result = calculate_carbon_footprint(data, region_category)
         
         # Calculate environmental impact metrics
-        impact_metrics = calculate_environmental_impact(result['total'])
+        impact_metrics = calculate_environmental_impact(result['total'], region_category, result['breakdown'])
         
         # Get weather data for context
         weather_data = get_weather_data(region['city'], region['country'])
@@ -545,8 +1277,13 @@ def calculate():
         # Check if user is premium
         is_premium = session.get('user', {}).get('premium', False)
         
-        # Generate AI suggestions
-        suggestions = generate_eco_suggestions(result, region, weather_data, is_premium)
+        # Generate AI suggestions, or queue them and answer with fallbacks right away
+        suggestions_job_id = None
+        if data.get('defer_suggestions', DEFER_AI_SUGGESTIONS):
+            suggestions = get_fallback_suggestions(result)
+            suggestions_job_id = enqueue_suggestions(result, region, weather_data, is_premium)
+        else:
+            suggestions = generate_eco_suggestions(result, region, weather_data, is_premium)
         
         # Save calculation if user is logged in
         if session.get('user_id'):
@@ -564,6 +1301,7 @@ def calculate():
             'carbon_footprint': result,
             'region': region,
             'suggestions': suggestions,
+            'suggestions_job_id': suggestions_job_id,
             'weather': weather_data,
             'is_premium': is_premium,
             'impact_metrics': impact_metrics
@@ -576,6 +1314,35 @@ def calculate():
             'error': 'Calculation failed. Please check your input and try again.'
         }), 400
 
+@app.route('/api/suggestions/<job_id>', methods=['GET'])
+def get_suggestions(job_id):
+    """Fetch deferred AI suggestions; ?wait=N long-polls up to N seconds"""
+    try:
+        wait = min(max(float(request.args.get('wait', 0)), 0), SUGGESTIONS_MAX_WAIT)
+    except ValueError:
+        wait = 0
+    
+    try:
+        job = job_queue.wait(job_id, wait) if wait else job_queue.get(job_id)
+        if job is None or job['kind'] != 'eco_suggestions':
+            return jsonify({'success': False, 'error': 'Unknown suggestions job'}), 404
+        
+        if job['status'] == 'done':
+            suggestions = job['result']
+        elif job['status'] == 'failed':
+            suggestions = get_fallback_suggestions(job['payload']['carbon_footprint'])
+        else:
+            suggestions = None
+        
+        return jsonify({
+            'success': True,
+            'status': job['status'],
+            'suggestions': suggestions
+        })
+    except Exception as e:
+        print(f"Suggestions job error: {str(e)}")
+        return jsonify({'success': False, 'error': 'Failed to load suggestions'}), 500
+
 @app.route('/api/region', methods=['GET'])
 def get_region():
     """Get default region information"""
@@ -617,61 +1384,56 @@ def ecobot_chat():
                 'error': 'Please provide a valid message.'
             }), 400
         
+        # Load server-side conversation state for this session
+        if data.get('reset') or not session.get('ecobot_conversation_id'):
+            session['ecobot_conversation_id'] = str(uuid.uuid4())
+        conversation_id = session['ecobot_conversation_id']
+        summary, turns = load_conversation(conversation_id)
+        has_history = bool(summary or turns)
+        
+        # Answer repeated FAQ-style questions from this tier's cache (follow-ups depend on context)
+        is_premium = session.get('user', {}).get('premium', False)
+        answer_cache = ecobot_answer_caches[llm_tier(is_premium)]
+        cached_response = None if has_history else answer_cache.get(user_message)
+        if cached_response is not None:
+            record_ecobot_turn(conversation_id, summary, turns, user_message, cached_response)
+            track_analytics('ecobot_chat', session.get('user_id'), {
+                'user_message': user_message,
+                'response_length': len(cached_response),
+                'cached': True
+            })
+            return jsonify({
+                'success': True,
+                'response': cached_response,
+                'cached': True
+            })
+        
         # Get user's location and context
         region = get_default_region()
         weather_data = get_weather_data(region['city'], region['country'])
+        context = f"User location: {region['city']}, {region['country']}. {weather_summary(weather_data)}"
         
-        # Build context for Perplexity Sonar Pro
-        context = f"""
-        User location: {region['city']}, {region['country']}
-        """
-        
-        if weather_data:
-            context += f"Weather: {weather_data.get('weather', [{}])[0].get('main', 'Unknown')}, Temperature: {weather_data.get('main', {}).get('temp', 'Unknown')}°C"
-        
-        # Create prompt for Perplexity Sonar Pro
-        prompt = f"""
-        You are EcoBot, an AI-powered sustainability assistant. The user is asking: "{user_message}"
-        
-        Context: {context}
-        
-        Provide a helpful, informative response about sustainability, carbon reduction, green living, or environmental topics. 
-        Focus on practical, actionable advice. Keep the response conversational and engaging.
-        """
-        
-        # Perplexity Sonar Pro API call
-        headers = {
-            "Authorization": f"Bearer {PERPLEXITY_API_KEY}",
-            "Content-Type": "application/json"
-        }
+        # Token-budgeted prompt: system context, rolling summary, recent turns, new question
+        messages = build_ecobot_messages(summary, turns, user_message, context)
         
-        payload = {
-            "model": "sonar-pro",
-            "messages": [
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ],
-            "max_tokens": 500,
-            "temperature": 0.7
-        }
-        
-        response = requests.post(
-            "https://api.perplexity.ai/chat/completions",
-            headers=headers,
-            json=payload
-        )
+        # Perplexity call, routed by tier (premium users get their own model, budget and SLO)
+        try:
+            ai_response = call_llm('ecobot', is_premium, messages)
+        except Exception as e:
+            print(f"EcoBot LLM error: {str(e)}")
+            ai_response = None
         
-        if response.status_code == 200:
-            response_data = response.json()
-            ai_response = response_data['choices'][0]['message']['content'].strip()
+        if ai_response:
+            if not has_history:
+                answer_cache.put(user_message, ai_response)
+            record_ecobot_turn(conversation_id, summary, turns, user_message, ai_response)
             
             # Track analytics
             track_analytics('ecobot_chat', session.get('user_id'), {
                 'user_message': user_message,
                 'region': region,
-                'response_length': len(ai_response)
+                'response_length': len(ai_response),
+                'prompt_tokens_estimate': sum(estimate_tokens(m['content']) for m in messages)
             })
             
             return jsonify({
@@ -679,7 +1441,6 @@ def ecobot_chat():
                 'response': ai_response
             })
         else:
-            print(f"Perplexity API error: {response.status_code} - {response.text}")
             return jsonify({
                 'success': False,
                 'error': 'AI service temporarily unavailable'
@@ -692,6 +1453,19 @@ def ecobot_chat():
             'error': 'An error occurred while processing your request'
         }), 500
 
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+    """Per-worker service metrics: cache, LLM latency and cost (requires X-Admin-Token)"""
+    if not is_admin_request():
+        return jsonify({'success': False, 'error': 'Forbidden'}), 403
+    
+    return jsonify({
+        'success': True,
+        'pid': os.getpid(),
+        'ecobot_cache': {tier: cache.stats() for tier, cache in ecobot_answer_caches.items()},
+        'llm': llm_metrics.snapshot()
+    })
+
 @app.route('/api/premium/upgrade', methods=['POST'])
 def upgrade_premium():
     """Handle premium upgrade (development mode)"""
@@ -702,11 +1476,8 @@ def upgrade_premium():
         
         # Simple premium upgrade for development
         try:
-            conn = sqlite3.connect('novelsync.db')
-            c = conn.cursor()
-            c.execute('UPDATE users SET premium = TRUE WHERE id = ?', (user_id,))
-            conn.commit()
-            conn.close()
+            with storage.transaction() as c:
+                c.execute('UPDATE users SET premium = TRUE WHERE id = ?', (user_id,))
             
             session['user']['premium'] = True
             track_analytics('premium_upgrade', user_id)
@@ -727,13 +1498,11 @@ def get_user_history():
         return jsonify({'success': False, 'message': 'Not logged in'})
     
     try:
-        conn = sqlite3.connect('novelsync.db')
-        c = conn.cursor()
-        c.execute('''SELECT carbon_total, breakdown, created_at 
-                     FROM calculations WHERE user_id = ? 
-                     ORDER BY created_at DESC LIMIT 10''', (user_id,))
-        history = c.fetchall()
-        conn.close()
+        with storage.transaction() as c:
+            c.execute('''SELECT carbon_total, breakdown, created_at 
+                         FROM calculations WHERE user_id = ? 
+                         ORDER BY created_at DESC LIMIT 10''', (user_id,))
+            history = c.fetchall()
         
         return jsonify({
             'success': True,
@@ -741,38 +1510,78 @@ def get_user_history():
                 {
                     'total': row[0],
                     'breakdown': json.loads(row[1]),
-                    'date': row[2]
+                    'date': str(row[2])
                 } for row in history
             ]
         })
     except:
         return jsonify({'success': False, 'message': 'Failed to load history'})
 
-@app.route('/api/analytics/dashboard', methods=['GET'])
-def analytics_dashboard():
-    """Get analytics dashboard data (admin only)"""
+@app.route('/api/user/trend', methods=['GET'])
+def get_user_trend():
+    """Get user's footprint trend summary"""
+    user_id = session.get('user_id')
+    if not user_id:
+        return jsonify({'success': False, 'message': 'Not logged in'})
+    
     try:
-        conn = sqlite3.connect('novelsync.db')
-        c = conn.cursor()
+        with storage.transaction() as c:
+            c.execute(f'SELECT {", ".join(TREND_COLUMNS)} FROM user_trends WHERE user_id = ?', (user_id,))
+            row = c.fetchone()
         
-        # Total calculations
-        c.execute('SELECT COUNT(*) FROM calculations')
-        total_calculations = c.fetchone()[0]
+        if not row:
+            return jsonify({'success': True, 'trend': None})
         
-        # Total carbon saved
-        c.execute('SELECT SUM(carbon_total) FROM calculations')
-        total_carbon = c.fetchone()[0] or 0
-        
-        # Premium users
-        c.execute('SELECT COUNT(*) FROM users WHERE premium = TRUE')
-        premium_users = c.fetchone()[0]
-        
-        # Recent activity
-        c.execute('''SELECT COUNT(*) FROM calculations 
-                     WHERE created_at >= datetime('now', '-7 days')''')
-        weekly_calculations = c.fetchone()[0]
+        trend = load_trend_row(row)
+        count = trend['calculation_count']
+        average = trend['carbon_sum'] / count
+        if abs(trend['ewma'] - average) <= 0.05 * average:
+            direction = 'steady'
+        else:
+            direction = 'improving' if trend['ewma'] < average else 'worsening'
         
-        conn.close()
+        return jsonify({
+            'success': True,
+            'trend': {
+                'calculations': count,
+                'total_kg': round(trend['carbon_sum'], 3),
+                'average_kg': round(average, 3),
+                'category_averages': {
+                    category: round(trend[f'{category}_sum'] / count, 3) for category in SUGGESTION_CATEGORIES
+                },
+                'ewma_kg': round(trend['ewma'], 3),
+                'last_kg': round(trend['last_total'], 3),
+                'direction': direction,
+                'best_period': {'period': trend['best_period'], 'average_kg': round(trend['best_period_avg'], 3)},
+                'worst_period': {'period': trend['worst_period'], 'average_kg': round(trend['worst_period_avg'], 3)},
+                'since': trend['first_period']
+            }
+        })
+    except Exception as e:
+        print(f"User trend error: {str(e)}")
+        return jsonify({'success': False, 'message': 'Failed to load trend'})
+
+@app.route('/api/analytics/dashboard', methods=['GET'])
+def analytics_dashboard():
+    """Get analytics dashboard data (admin only)"""
+    try:
+        with storage.transaction() as c:
+            # Total calculations
+            c.execute('SELECT COUNT(*) FROM calculations')
+            total_calculations = c.fetchone()[0]
+            
+            # Total carbon saved
+            c.execute('SELECT SUM(carbon_total) FROM calculations')
+            total_carbon = c.fetchone()[0] or 0
+            
+            # Premium users
+            c.execute('SELECT COUNT(*) FROM users WHERE premium = TRUE')
+            premium_users = c.fetchone()[0]
+            
+            # Recent activity
+            c.execute('''SELECT COUNT(*) FROM calculations 
+                         WHERE created_at >= ?''', (utc_timestamp(7 * 24 * 3600),))
+            weekly_calculations = c.fetchone()[0]
         
         return jsonify({
             'success': True,
@@ -797,18 +1606,261 @@ def set_carbon_goal():
         if not user_id:
             return jsonify({'success': False, 'message': 'Not logged in'})
         
-        conn = sqlite3.connect('novelsync.db')
-        c = conn.cursor()
-        c.execute('''INSERT INTO goals (id, user_id, target_carbon, current_carbon, deadline) 
-                     VALUES (?, ?, ?, ?, ?)''', 
-                  (str(uuid.uuid4()), user_id, data['target_carbon'], data['current_carbon'], data['deadline']))
-        conn.commit()
-        conn.close()
+        with storage.transaction() as c:
+            c.execute('''INSERT INTO goals (id, user_id, target_carbon, current_carbon, deadline) 
+                         VALUES (?, ?, ?, ?, ?)''', 
+                      (str(uuid.uuid4()), user_id, data['target_carbon'], data['current_carbon'], data['deadline']))
         
         return jsonify({'success': True, 'message': 'Goal set successfully'})
     except:
         return jsonify({'success': False, 'message': 'Failed to set goal'})
 
-if __name__ == '__main__':
+# Production startup
+# gunicorn preloads create_app() in the master (see gunicorn.conf.py), so schema
+# setup runs once and the tables, catalogs and compiled templates built here are
+# shared copy-on-write by every forked worker.
+APP_STATE = {
+    'ready': False,
+    'schema_version': None,
+    'templates': None,
+    'startup_ms': None,
+    'worker_boot_ms': None,
+    'worker_rss_kb': None
+}
+
+def current_rss_kb():
+    """Resident set size of this process in KiB"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() // 1024
+    except (OSError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def warm_template_cache():
+    """Compile every template into the Jinja cache and return how many were loaded"""
+    names = app.jinja_env.list_templates(extensions=['html'])
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+def create_app():
+    """Application factory: initialize the schema, warm caches and mark the app ready"""
+    if APP_STATE['ready']:
+        return app
+    started = time.perf_counter()
+    APP_STATE['schema_version'] = init_db()
+    APP_STATE['templates'] = warm_template_cache()
+    percentile_ranker.sync()
+    if not percentile_ranker.snapshot:
+        rebuild_quantile_sketches()
+        percentile_ranker.sync()
+    # Close startup connections so forked workers don't inherit (and share) them
+    storage.close()
+    APP_STATE['startup_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    APP_STATE['ready'] = True
+    # Move everything built so far out of the GC's reach so collections in the
+    # workers don't touch (and un-share) the preloaded pages
+    gc.freeze()
+    return app
+
+@app.cli.command('rebuild-sketches')
+def rebuild_sketches_command():
+    """Rebuild the footprint percentile sketches from stored calculations"""
     init_db()
+    print(f"Rebuilt percentile sketches from {rebuild_quantile_sketches()} calculations")
+
+@app.cli.command('rebuild-trends')
+def rebuild_trends_command():
+    """Backfill per-user trend summaries from stored calculations"""
+    init_db()
+    print(f"Rebuilt trend summaries for {rebuild_user_trends()} users")
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """Readiness check for load balancers"""
+    return jsonify({
+        'success': APP_STATE['ready'],
+        'pid': os.getpid(),
+        'rss_kb': current_rss_kb(),
+        **APP_STATE
+    }), 200 if APP_STATE['ready'] else 503
+
+# Memory accounting
+# Every request records the worker's RSS growth per route; with
+# MEMORY_TRACEMALLOC=true a random sample of requests also records the top
+# allocating source lines (tracing runs only while a sampled request is in
+# flight, so the other requests pay no tracemalloc overhead). Each worker
+# publishes its stats to MEMORY_STATS_DIR so the admin endpoint can show all
+# workers on this node, and gunicorn recycles a worker once its RSS passes
+# MAX_WORKER_RSS_MB (see post_request in gunicorn.conf.py).
+MEMORY_STATS_DIR = os.getenv('MEMORY_STATS_DIR', os.path.join(tempfile.gettempdir(), 'novelsync-memory'))
+MEMORY_TRACEMALLOC = os.getenv('MEMORY_TRACEMALLOC', 'false').lower() == 'true'
+MEMORY_TRACE_SAMPLE = int(os.getenv('MEMORY_TRACE_SAMPLE', '20'))  # trace 1 in N requests on average
+MEMORY_PUBLISH_INTERVAL = int(os.getenv('MEMORY_PUBLISH_INTERVAL', '10'))  # seconds
+MAX_WORKER_RSS_MB = int(os.getenv('MAX_WORKER_RSS_MB', '512'))
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+
+def is_admin_request():
+    """Whether the request carries ADMIN_TOKEN in X-Admin-Token (always False when unset)"""
+    token = request.headers.get('X-Admin-Token', '')
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+class MemoryTracker:
+    """Per-worker RSS and tracemalloc accounting, keyed by route"""
+
+    def __init__(self):
+        self.routes = {}
+        self.requests = 0
+        self.traced_requests = 0
+        self.started_tracing = False
+        self.last_publish = 0.0
+        self.lock = threading.Lock()
+
+    def start_request(self):
+        g.rss_before = current_rss_kb()
+        with self.lock:
+            self.requests += 1
+            # Random rather than every Nth request, so regular request patterns can't alias
+            sampled = MEMORY_TRACEMALLOC and random.random() < 1 / MEMORY_TRACE_SAMPLE
+            if sampled:
+                self.traced_requests += 1
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    self.started_tracing = True
+        if sampled:
+            g.trace_before = tracemalloc.take_snapshot()
+
+    def finish_request(self, response):
+        rss = current_rss_kb()
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        growth = rss - g.get('rss_before', rss)
+        top = []
+        if g.get('trace_before') is not None:
+            after = tracemalloc.take_snapshot().filter_traces(TRACE_FILTERS)
+            top = [(str(stat.traceback[0]), stat.size_diff)
+                   for stat in after.compare_to(g.trace_before.filter_traces(TRACE_FILTERS), 'lineno')[:10]
+                   if stat.size_diff > 0]
+            g.trace_before = None
+            with self.lock:
+                self.traced_requests -= 1
+                # Stop once no sampled request is in flight (leave tracing started elsewhere alone)
+                if self.traced_requests == 0 and self.started_tracing:
+                    tracemalloc.stop()
+                    self.started_tracing = False
+        session_bytes = len(json.dumps(dict(session), default=str)) if session else 0
+        with self.lock:
+            stats = self.routes.setdefault(route, {
+                'requests': 0, 'rss_growth_kb': 0, 'max_rss_growth_kb': 0,
+                'response_bytes': 0, 'max_session_bytes': 0, 'allocators': Counter()
+            })
+            stats['requests'] += 1
+            stats['rss_growth_kb'] += max(growth, 0)
+            stats['max_rss_growth_kb'] = max(stats['max_rss_growth_kb'], growth)
+            stats['response_bytes'] += response.content_length or 0
+            stats['max_session_bytes'] = max(stats['max_session_bytes'], session_bytes)
+            for location, size in top:
+                stats['allocators'][location] += size
+            due = time.time() - self.last_publish >= MEMORY_PUBLISH_INTERVAL
+        if due:
+            self.publish()
+
+    def snapshot(self):
+        with self.lock:
+            routes = {
+                route: {
+                    'requests': stats['requests'],
+                    'rss_growth_kb': stats['rss_growth_kb'],
+                    'max_rss_growth_kb': stats['max_rss_growth_kb'],
+                    'avg_response_bytes': stats['response_bytes'] // stats['requests'],
+                    'max_session_bytes': stats['max_session_bytes'],
+                    'top_allocators': [{'location': loc, 'size_diff_bytes': size}
+                                       for loc, size in stats['allocators'].most_common(10)]
+                }
+                for route, stats in self.routes.items()
+            }
+            requests_served = self.requests
+        return {
+            'pid': os.getpid(),
+            'rss_kb': current_rss_kb(),
+            'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'requests': requests_served,
+            'tracemalloc_sampling': MEMORY_TRACEMALLOC,
+            'routes': routes,
+            'updated_at': time.time()
+        }
+
+    def _path(self):
+        return os.path.join(MEMORY_STATS_DIR, f'{os.getpid()}.json')
+
+    def publish(self):
+        """Write this worker's stats for the admin endpoint (atomic replace)"""
+        self.last_publish = time.time()
+        try:
+            os.makedirs(MEMORY_STATS_DIR, exist_ok=True)
+            tmp_path = self._path() + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp_path, self._path())
+        except OSError as e:
+            print(f"Memory stats publish error: {str(e)}")
+
+    def discard(self):
+        """Remove this worker's published stats (on worker exit)"""
+        try:
+            os.remove(self._path())
+        except OSError:
+            pass
+
+def collect_worker_memory():
+    """Published stats of every live worker on this node"""
+    workers = []
+    try:
+        names = os.listdir(MEMORY_STATS_DIR)
+    except OSError:
+        names = []
+    for name in names:
+        if not name.endswith('.json'):
+            continue
+        try:
+            pid = int(name[:-len('.json')])
+            os.kill(pid, 0)
+            with open(os.path.join(MEMORY_STATS_DIR, name)) as f:
+                workers.append(json.load(f))
+        except (ValueError, ProcessLookupError, PermissionError, OSError, json.JSONDecodeError):
+            continue
+    return sorted(workers, key=lambda worker: worker['pid'])
+
+# Leave tracemalloc itself and the tracker's own lines out of the allocator stats
+_tracker_source, _tracker_start = inspect.getsourcelines(MemoryTracker)
+TRACE_FILTERS = [tracemalloc.Filter(False, tracemalloc.__file__),
+                 tracemalloc.Filter(False, '<frozen importlib._bootstrap>')]
+TRACE_FILTERS += [tracemalloc.Filter(False, __file__, lineno)
+                  for lineno in range(_tracker_start, _tracker_start + len(_tracker_source))]
+memory_tracker = MemoryTracker()
+
+@app.before_request
+def track_memory_start():
+    memory_tracker.start_request()
+
+@app.after_request
+def track_memory_finish(response):
+    memory_tracker.finish_request(response)
+    return response
+
+@app.route('/api/admin/memory', methods=['GET'])
+def admin_memory():
+    """Per-worker memory accounting (requires X-Admin-Token)"""
+    if not is_admin_request():
+        return jsonify({'success': False, 'error': 'Forbidden'}), 403
+    
+    # Refresh this worker's entry so the response is current for at least one worker
+    memory_tracker.publish()
+    return jsonify({
+        'success': True,
+        'max_worker_rss_mb': MAX_WORKER_RSS_MB,
+        'workers': collect_worker_memory()
+    })
+
+if __name__ == '__main__':
+    create_app()
     app.run(debug=True, host='0.0.0.0', port=5000) 
\ No newline at end of file
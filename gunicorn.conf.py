@@ -1,5 +1,12 @@
 # Gunicorn configuration for NovelSync production deployment
 
+import sys
+import time
+
+# Application: build the app once in the master and fork workers from it
+wsgi_app = "app:create_app()"
+preload_app = True
+
 # Server socket
 bind = "0.0.0.0:8000"
 backlog = 2048
@@ -11,9 +18,9 @@ worker_connections = 1000
 timeout = 30
 keepalive = 2
 
-# Restart workers after this many requests, to help prevent memory leaks
-max_requests = 1000
-max_requests_jitter = 50
+# Workers are recycled by memory use (MAX_WORKER_RSS_MB, see post_request)
+# rather than after a fixed number of requests
+max_requests = 0
 
 # Logging
 accesslog = "-"
@@ -37,4 +44,40 @@ tmp_upload_dir = None
 # Security
 limit_request_line = 4094
 limit_request_fields = 100
-limit_request_field_size = 8190 
\ No newline at end of file
+limit_request_field_size = 8190 
+
+# Server hooks: report worker boot time and resident memory
+def pre_fork(server, worker):
+    worker.fork_started = time.perf_counter()
+
+def post_worker_init(worker):
+    novelsync = sys.modules.get('app')
+    if novelsync is None:
+        return
+    boot_ms = round((time.perf_counter() - worker.fork_started) * 1000, 1)
+    rss_kb = novelsync.current_rss_kb()
+    novelsync.APP_STATE['worker_boot_ms'] = boot_ms
+    novelsync.APP_STATE['worker_rss_kb'] = rss_kb
+    worker.log.info("Worker %s booted in %.1f ms, RSS %d KiB", worker.pid, boot_ms, rss_kb)
+    # Resume queued jobs (including ones left behind by a recycled worker)
+    novelsync.job_queue.start()
+
+def post_request(worker, req, environ, resp):
+    novelsync = sys.modules.get('app')
+    if novelsync is None or not worker.alive:
+        return
+    rss_kb = novelsync.current_rss_kb()
+    if rss_kb > novelsync.MAX_WORKER_RSS_MB * 1024:
+        # Finish in-flight work and exit gracefully; the arbiter forks a replacement
+        worker.log.warning("Worker %s RSS %d KiB exceeds %d MiB after %s %s, recycling",
+                           worker.pid, rss_kb, novelsync.MAX_WORKER_RSS_MB, req.method, req.path)
+        novelsync.memory_tracker.publish()
+        worker.alive = False
+
+def worker_exit(server, worker):
+    novelsync = sys.modules.get('app')
+    if novelsync is not None:
+        novelsync.memory_tracker.discard()
+        # Flush percentile sketch values and analytics rows this worker has not written yet
+        novelsync.percentile_ranker.sync()
+        novelsync.storage.flush()
@@ -0,0 +1,202 @@
+"""Durable local job queue for NovelSync.
+
+Jobs live in a node-local SQLite file and are executed by daemon worker
+threads in each web process. Claims are leased, so jobs held by a process
+that died are picked up again once the lease expires, unless that was their
+last attempt. Failed jobs are retried with exponential backoff, and enqueueing
+a job identical to one that is pending (or finished recently) returns the
+existing job instead of adding work.
+
+Results are stored on the node that ran the job. When several web nodes run
+behind a load balancer, route polling requests with session affinity.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+TERMINAL_STATUSES = ('done', 'failed')
+
+class JobQueue:
+    """SQLite-backed job queue with worker threads, retries and deduplication"""
+
+    def __init__(self, path='novelsync_jobs.db', workers=2, max_attempts=3, lease_seconds=60,
+                 result_ttl=3600, poll_interval=1.0):
+        self.path = path
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.result_ttl = result_ttl
+        self.poll_interval = poll_interval
+        self.handlers = {}
+        self._started_pid = None
+        self._start_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._finished = threading.Condition()
+        self._schema_ready = False
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, isolation_level=None, timeout=30)
+        if not self._schema_ready:
+            conn.execute('''CREATE TABLE IF NOT EXISTS jobs
+                            (id TEXT PRIMARY KEY, kind TEXT, dedup_key TEXT, payload TEXT,
+                             status TEXT, attempts INTEGER DEFAULT 0, result TEXT, error TEXT,
+                             run_after REAL, locked_until REAL, created_at REAL, updated_at REAL)''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_dedup ON jobs (dedup_key, status)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, run_after)')
+            self._schema_ready = True
+        return conn
+
+    def register(self, kind, handler):
+        """Register handler(payload) -> JSON-serializable result for a job kind"""
+        self.handlers[kind] = handler
+
+    def start(self):
+        """Start worker threads in this process (once per process, safe after fork)"""
+        with self._start_lock:
+            if self._started_pid == os.getpid():
+                return
+            self._started_pid = os.getpid()
+            for number in range(self.workers):
+                threading.Thread(target=self._work, name=f'job-worker-{number}', daemon=True).start()
+
+    def enqueue(self, kind, payload, dedup_key=None):
+        """Queue a job and return its id, reusing an identical pending or recent job"""
+        self.start()
+        if dedup_key is None:
+            dedup_key = json.dumps(payload, sort_keys=True, default=str)
+        dedup_key = hashlib.sha256(f'{kind}:{dedup_key}'.encode()).hexdigest()
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('''SELECT id FROM jobs WHERE dedup_key = ?
+                                  AND (status IN ('queued', 'running') OR (status = 'done' AND updated_at >= ?))
+                                  ORDER BY created_at DESC LIMIT 1''',
+                               (dedup_key, now - self.result_ttl)).fetchone()
+            if row:
+                job_id = row[0]
+            else:
+                job_id = str(uuid.uuid4())
+                conn.execute('''INSERT INTO jobs (id, kind, dedup_key, payload, status, run_after, created_at, updated_at)
+                                VALUES (?, ?, ?, ?, 'queued', ?, ?, ?)''',
+                             (job_id, kind, dedup_key, json.dumps(payload), now, now, now))
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+        self._wakeup.set()
+        return job_id
+
+    def get(self, job_id):
+        """Return the job as a dict, or None if it doesn't exist"""
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT kind, payload, status, attempts, result, error FROM jobs WHERE id = ?',
+                               (job_id,)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        return {
+            'id': job_id,
+            'kind': row[0],
+            'payload': json.loads(row[1]),
+            'status': row[2],
+            'attempts': row[3],
+            'result': json.loads(row[4]) if row[4] else None,
+            'error': row[5]
+        }
+
+    def wait(self, job_id, timeout):
+        """Long-poll: return the job once it is finished or timeout seconds have passed"""
+        self.start()
+        deadline = time.time() + timeout
+        while True:
+            job = self.get(job_id)
+            remaining = deadline - time.time()
+            if job is None or job['status'] in TERMINAL_STATUSES or remaining <= 0:
+                return job
+            # Local workers notify on completion; jobs run by other processes are polled
+            with self._finished:
+                self._finished.wait(min(remaining, self.poll_interval))
+
+    def _claim(self):
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            # A lease that expired on the last attempt means the job keeps killing its worker: give up
+            conn.execute('''UPDATE jobs SET status = 'failed', error = 'Lease expired on the last attempt',
+                            locked_until = NULL, updated_at = ?
+                            WHERE status = 'running' AND locked_until < ? AND attempts >= ?''',
+                         (now, now, self.max_attempts))
+            row = conn.execute('''SELECT id, kind, payload, attempts FROM jobs
+                                  WHERE (status = 'queued' AND run_after <= ?)
+                                     OR (status = 'running' AND locked_until < ? AND attempts < ?)
+                                  ORDER BY created_at LIMIT 1''', (now, now, self.max_attempts)).fetchone()
+            if row:
+                conn.execute('''UPDATE jobs SET status = 'running', attempts = attempts + 1,
+                                locked_until = ?, updated_at = ? WHERE id = ?''',
+                             (now + self.lease_seconds, now, row[0]))
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+        return row
+
+    def _finish(self, job_id, status, result=None, error=None, run_after=None):
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('''UPDATE jobs SET status = ?, result = ?, error = ?, run_after = ?,
+                            locked_until = NULL, updated_at = ? WHERE id = ?''',
+                         (status, json.dumps(result) if result is not None else None, error,
+                          run_after if run_after is not None else now, now, job_id))
+        finally:
+            conn.close()
+        with self._finished:
+            self._finished.notify_all()
+
+    def _purge(self):
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+                         (time.time() - self.result_ttl,))
+        finally:
+            conn.close()
+
+    def _work(self):
+        last_purge = 0.0
+        while True:
+            try:
+                job = self._claim()
+            except Exception as e:
+                print(f"Job claim error: {str(e)}")
+                job = None
+            if job is None:
+                if time.time() - last_purge > self.result_ttl:
+                    last_purge = time.time()
+                    try:
+                        self._purge()
+                    except Exception as e:
+                        print(f"Job purge error: {str(e)}")
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            self._run(job)
+
+    def _run(self, job):
+        """Run a claimed job; failures are retried with exponential backoff up to max_attempts"""
+        job_id, kind, payload, attempts = job
+        attempts += 1
+        try:
+            result = self.handlers[kind](json.loads(payload))
+            self._finish(job_id, 'done', result=result)
+        except Exception as e:
+            print(f"Job {kind} {job_id} attempt {attempts} failed: {str(e)}")
+            if attempts < self.max_attempts:
+                self._finish(job_id, 'queued', error=str(e), run_after=time.time() + 2 ** attempts)
+            else:
+                self._finish(job_id, 'failed', error=str(e))
@@ -0,0 +1,310 @@
+"""Storage backends for NovelSync.
+
+SQLiteStorage keeps everything in a local file (single node, development).
+PostgresStorage talks to a shared PostgreSQL-compatible server through a
+per-process connection pool, so any number of web nodes can sit behind a load
+balancer. Application code writes portable SQL with '?' placeholders and runs
+it through Storage.transaction(); the backend adapts the dialect.
+"""
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+# Base tables; later changes go through the migration list passed to migrate()
+BASE_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS users
+       (id TEXT PRIMARY KEY, email TEXT UNIQUE, password_hash TEXT,
+        premium BOOLEAN DEFAULT FALSE, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+    '''CREATE TABLE IF NOT EXISTS calculations
+       (id TEXT PRIMARY KEY, user_id TEXT, carbon_total DOUBLE PRECISION,
+        breakdown TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+    '''CREATE TABLE IF NOT EXISTS analytics
+       (id TEXT PRIMARY KEY, event_type TEXT, user_id TEXT,
+        data TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+    '''CREATE TABLE IF NOT EXISTS goals
+       (id TEXT PRIMARY KEY, user_id TEXT, target_carbon DOUBLE PRECISION,
+        current_carbon DOUBLE PRECISION, deadline DATE, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+    '''CREATE TABLE IF NOT EXISTS subscriptions
+       (id TEXT PRIMARY KEY, user_id TEXT, stripe_subscription_id TEXT,
+        status TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+    '''CREATE TABLE IF NOT EXISTS conversations
+       (id TEXT PRIMARY KEY, summary TEXT, turns TEXT,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+    'CREATE INDEX IF NOT EXISTS idx_conversations_updated_at ON conversations (updated_at)',
+]
+
+class Transaction:
+    """Cursor wrapper that adapts '?' placeholders to the backend's paramstyle"""
+
+    def __init__(self, cursor, placeholder):
+        self.cursor = cursor
+        self.placeholder = placeholder
+
+    def _sql(self, sql):
+        return sql if self.placeholder == '?' else sql.replace('?', self.placeholder)
+
+    def execute(self, sql, params=()):
+        self.cursor.execute(self._sql(sql), tuple(params))
+        return self
+
+    def executemany(self, sql, rows):
+        self.cursor.executemany(self._sql(sql), rows)
+        return self
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+class Storage:
+    """Backend interface shared by SQLite and PostgreSQL"""
+
+    placeholder = '?'
+    for_update = ''
+
+    def _connect(self):
+        raise NotImplementedError
+
+    def _release(self, conn, broken=False):
+        raise NotImplementedError
+
+    def _is_broken(self, conn, error):
+        """Whether error left conn unusable (it is then discarded instead of reused)"""
+        return False
+
+    def _begin(self, cursor, lock, shared_lock=None):
+        raise NotImplementedError
+
+    def schema_version(self, tx):
+        raise NotImplementedError
+
+    def set_schema_version(self, tx, version):
+        raise NotImplementedError
+
+    @contextmanager
+    def transaction(self, lock=None, shared_lock=None):
+        """Run statements in one transaction.
+
+        lock names a critical section to serialize. shared_lock names a section
+        any number of transactions may hold at once, but not while another
+        transaction holds the same name as its lock.
+        """
+        conn = self._connect()
+        broken = False
+        try:
+            cursor = conn.cursor()
+            self._begin(cursor, lock, shared_lock)
+            yield Transaction(cursor, self.placeholder)
+            conn.commit()
+        except Exception as e:
+            broken = self._is_broken(conn, e)
+            if not broken:
+                conn.rollback()
+            raise
+        finally:
+            self._release(conn, broken)
+
+    def migrate(self, migrations):
+        """Create base tables and apply pending migrations exactly once; return the schema version"""
+        with self.transaction(lock='schema') as tx:
+            for statement in BASE_SCHEMA:
+                tx.execute(statement)
+            version = self.schema_version(tx)
+            for number, statements in enumerate(migrations[version:], start=version + 1):
+                for statement in statements:
+                    tx.execute(statement)
+                self.set_schema_version(tx, number)
+            return max(version, len(migrations))
+
+    def upsert(self, tx, table, keys, row):
+        """Insert row, or update its non-key columns when the key already exists"""
+        columns = list(row)
+        updates = ', '.join(f'{col} = excluded.{col}' for col in columns if col not in keys)
+        tx.execute(f'''INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})
+                       ON CONFLICT ({', '.join(keys)}) DO UPDATE SET {updates}''',
+                   [row[col] for col in columns])
+
+    def insert_many(self, tx, table, columns, rows):
+        """Insert rows with a single multi-row VALUES statement"""
+        if not rows:
+            return
+        values = ', '.join('(' + ', '.join('?' * len(columns)) + ')' for _ in rows)
+        tx.execute(f"INSERT INTO {table} ({', '.join(columns)}) VALUES {values}",
+                   [value for row in rows for value in row])
+
+    def record_event(self, row):
+        """Store an analytics row (id, event_type, user_id, data)"""
+        with self.transaction() as tx:
+            self.insert_many(tx, 'analytics', ('id', 'event_type', 'user_id', 'data'), [row])
+
+    def flush(self):
+        """Write out any buffered rows"""
+
+    def close(self):
+        """Close pooled connections (call before forking); later transactions reconnect"""
+
+class SQLiteStorage(Storage):
+    """Single-file SQLite storage; each transaction opens its own connection"""
+
+    def __init__(self, path='novelsync.db'):
+        self.path = path
+
+    def _connect(self):
+        return sqlite3.connect(self.path, isolation_level=None, timeout=30)
+
+    def _release(self, conn, broken=False):
+        conn.close()
+
+    def _begin(self, cursor, lock, shared_lock=None):
+        # BEGIN IMMEDIATE takes the database write lock up front (it covers shared locks too)
+        cursor.execute('BEGIN IMMEDIATE' if lock or shared_lock else 'BEGIN')
+
+    def schema_version(self, tx):
+        return tx.execute('PRAGMA user_version').fetchone()[0]
+
+    def set_schema_version(self, tx, version):
+        tx.execute(f'PRAGMA user_version = {int(version)}')
+
+class PostgresStorage(Storage):
+    """PostgreSQL-compatible storage with pooled connections and batched analytics writes.
+
+    pool may be any object with getconn()/putconn() (e.g. a fake for tests);
+    by default a psycopg2 ThreadedConnectionPool is created lazily per process.
+    Call close() before forking (create_app() does): a pool inherited across a
+    fork is replaced in the child but kept referenced, so its connections,
+    which belong to the parent, are never closed from the child.
+
+    Analytics rows are flushed once batch_size rows are buffered or, from a
+    background thread, flush_interval seconds after the last flush. A failed
+    flush puts its rows back in the buffer (up to max_buffered rows).
+    """
+
+    placeholder = '%s'
+    for_update = ' FOR UPDATE'
+
+    def __init__(self, dsn=None, pool=None, min_connections=1, max_connections=10,
+                 batch_size=50, flush_interval=5.0, max_buffered=5000):
+        self.dsn = dsn
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self._pool = pool
+        self._owns_pool = pool is None
+        self._pool_pid = os.getpid() if pool is not None else None
+        self._pool_lock = threading.Lock()
+        self._inherited_pools = []
+        self._events = []
+        self._events_lock = threading.Lock()
+        self._last_flush = time.time()
+        self._flusher_pid = None
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                if self._pool is not None:
+                    # Garbage-collecting it would close the parent's sockets
+                    self._inherited_pools.append(self._pool)
+                from psycopg2.pool import ThreadedConnectionPool
+                self._pool = ThreadedConnectionPool(self.min_connections, self.max_connections, self.dsn,
+                                                    options='-c timezone=UTC')
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def _connect(self):
+        return self._get_pool().getconn()
+
+    def _release(self, conn, broken=False):
+        # close=True drops a dead connection from the pool instead of handing it out again
+        self._get_pool().putconn(conn, close=broken)
+
+    def close(self):
+        # A pool passed in by the caller is the caller's to close
+        with self._pool_lock:
+            if self._owns_pool and self._pool is not None and self._pool_pid == os.getpid():
+                self._pool.closeall()
+                self._pool = None
+
+    def _is_broken(self, conn, error):
+        import psycopg2
+        return bool(conn.closed) or isinstance(error, (psycopg2.OperationalError, psycopg2.InterfaceError))
+
+    def _begin(self, cursor, lock, shared_lock=None):
+        # Transactions start implicitly; named locks map to transaction-scoped advisory locks
+        if shared_lock:
+            cursor.execute('SELECT pg_advisory_xact_lock_shared(hashtext(%s))', (shared_lock,))
+        if lock:
+            cursor.execute('SELECT pg_advisory_xact_lock(hashtext(%s))', (lock,))
+
+    def schema_version(self, tx):
+        tx.execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)')
+        row = tx.execute('SELECT version FROM schema_version').fetchone()
+        return row[0] if row else 0
+
+    def set_schema_version(self, tx, version):
+        tx.execute('DELETE FROM schema_version')
+        tx.execute('INSERT INTO schema_version (version) VALUES (?)', (version,))
+
+    def record_event(self, row):
+        self._start_flusher()
+        with self._events_lock:
+            self._events.append(row)
+            due = len(self._events) >= self.batch_size
+        if due:
+            self.flush()
+
+    def _start_flusher(self):
+        """Start the interval flush thread (once per process, safe after fork)"""
+        with self._events_lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+        threading.Thread(target=self._flush_periodically, name='analytics-flush', daemon=True).start()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.flush_interval)
+            if time.time() - self._last_flush >= self.flush_interval:
+                try:
+                    self.flush()
+                except Exception as e:
+                    print(f"Analytics flush error: {str(e)}")
+
+    def flush(self):
+        with self._events_lock:
+            events, self._events = self._events, []
+            self._last_flush = time.time()
+        if not events:
+            return
+        try:
+            with self.transaction() as tx:
+                self.insert_many(tx, 'analytics', ('id', 'event_type', 'user_id', 'data'), events)
+        except Exception:
+            # Put the batch back for the next flush; drop the oldest rows if the database stays down
+            with self._events_lock:
+                self._events[:0] = events
+                dropped = max(0, len(self._events) - self.max_buffered)
+                del self._events[:dropped]
+            if dropped:
+                print(f"Analytics buffer full, dropped {dropped} events")
+            raise
+
+def create_storage(url=None):
+    """Build the storage backend for DATABASE_URL (sqlite:///path or postgresql://...)"""
+    url = url or 'sqlite:///novelsync.db'
+    if url.startswith(('postgres://', 'postgresql://')):
+        return PostgresStorage(
+            url,
+            min_connections=int(os.getenv('DB_POOL_MIN', '1')),
+            max_connections=int(os.getenv('DB_POOL_MAX', '10')),
+            batch_size=int(os.getenv('ANALYTICS_BATCH_SIZE', '50')),
+            flush_interval=float(os.getenv('ANALYTICS_FLUSH_INTERVAL', '5')),
+            max_buffered=int(os.getenv('ANALYTICS_MAX_BUFFERED', '5000'))
+        )
+    if url.startswith('sqlite:///'):
+        return SQLiteStorage(url[len('sqlite:///'):])
+    raise ValueError(f"Unsupported DATABASE_URL: {url}")
@@ -0,0 +1,21 @@
+"""EcoBot question normalization and the near-duplicate answer cache."""
+from app import AnswerCache, normalize_question
+
+def test_normalize_question_keeps_negations_and_direction_words():
+    assert normalize_question('Should I eat meat?') == ['eat', 'meat']
+    assert normalize_question('Should I eat no meat?') == ['eat', 'no', 'meat']
+    assert normalize_question('Should I turn the heating up?') != normalize_question('Should I turn the heating down?')
+
+def test_normalize_question_stems_verb_forms_alike():
+    assert normalize_question('How to reduce food waste') == normalize_question('Reducing food wastes?')
+
+def test_negated_question_does_not_hit_cached_answer():
+    cache = AnswerCache()
+    cache.put('Should I eat meat?', 'meat answer')
+    assert cache.get('Should I eat meat?') == 'meat answer'
+    assert cache.get('Should I eat no meat?') is None
+
+def test_paraphrase_hits_cached_answer():
+    cache = AnswerCache()
+    cache.put('How can I reduce food waste?', 'food waste answer')
+    assert cache.get('how to reduce my food waste') == 'food waste answer'
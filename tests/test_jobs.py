@@ -0,0 +1,84 @@
+"""JobQueue deduplication, retries with backoff and lease recovery.
+
+Queues are built with workers=0, so no background threads run and each test
+claims and runs jobs itself.
+"""
+import time
+
+import pytest
+
+from jobs import JobQueue
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = JobQueue(path=str(tmp_path / 'jobs.db'), workers=0, max_attempts=3, lease_seconds=60)
+    queue.register('echo', lambda payload: payload)
+    return queue
+
+def make_due(queue, job_id):
+    """Move a job's backoff or lease into the past"""
+    conn = queue._connect()
+    try:
+        conn.execute('UPDATE jobs SET run_after = 0, locked_until = 0 WHERE id = ?', (job_id,))
+    finally:
+        conn.close()
+
+def test_identical_jobs_are_deduplicated(queue):
+    first = queue.enqueue('echo', {'n': 1})
+    assert queue.enqueue('echo', {'n': 1}) == first
+    assert queue.enqueue('echo', {'n': 2}) != first
+    assert queue.enqueue('echo', {'n': 3}, dedup_key='same') == queue.enqueue('echo', {'n': 4}, dedup_key='same')
+
+def test_finished_job_is_reused_within_result_ttl(queue):
+    job_id = queue.enqueue('echo', {'n': 1})
+    queue._run(queue._claim())
+    assert queue.get(job_id)['status'] == 'done'
+    assert queue.get(job_id)['result'] == {'n': 1}
+    assert queue.enqueue('echo', {'n': 1}) == job_id
+
+def test_failures_retry_with_backoff_then_fail(queue):
+    calls = []
+    def flaky(payload):
+        calls.append(payload)
+        raise RuntimeError('upstream down')
+    queue.register('flaky', flaky)
+    job_id = queue.enqueue('flaky', {})
+
+    queue._run(queue._claim())
+    job = queue.get(job_id)
+    assert (job['status'], job['attempts'], job['error']) == ('queued', 1, 'upstream down')
+    assert queue._claim() is None  # backing off for 2 seconds
+
+    make_due(queue, job_id)
+    queue._run(queue._claim())
+    assert queue.get(job_id)['status'] == 'queued'
+    make_due(queue, job_id)
+    queue._run(queue._claim())
+    assert queue.get(job_id)['status'] == 'failed'
+    assert len(calls) == 3
+
+def test_expired_lease_is_claimed_again(queue):
+    job_id = queue.enqueue('echo', {'n': 1})
+    assert queue._claim()[0] == job_id
+    assert queue._claim() is None  # still leased
+    make_due(queue, job_id)
+    claimed = queue._claim()
+    assert claimed[0] == job_id and claimed[3] == 1
+    queue._run(claimed)
+    assert queue.get(job_id)['status'] == 'done'
+
+def test_expired_lease_on_last_attempt_fails_the_job(queue):
+    job_id = queue.enqueue('echo', {'n': 1})
+    for _ in range(3):
+        assert queue._claim()[0] == job_id  # worker dies without finishing
+        make_due(queue, job_id)
+    assert queue._claim() is None
+    job = queue.get(job_id)
+    assert (job['status'], job['attempts']) == ('failed', 3)
+
+def test_wait_returns_once_job_finishes(queue):
+    job_id = queue.enqueue('echo', {'n': 1})
+    queue._run(queue._claim())
+    started = time.time()
+    assert queue.wait(job_id, 5)['status'] == 'done'
+    assert time.time() - started < 1
@@ -0,0 +1,138 @@
+"""PostgresStorage against an in-process fake connection pool.
+
+The fake speaks the psycopg2 pool/connection/cursor interface on top of a
+SQLite file: it translates %s placeholders back to '?', records advisory
+locks instead of taking them and logs every statement it receives.
+"""
+import sqlite3
+
+import psycopg2
+import pytest
+
+from storage import PostgresStorage
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.cursor = conn.db.cursor()
+
+    def execute(self, sql, params=()):
+        self.conn.pool.statements.append(sql)
+        if self.conn.pool.fail_next is not None:
+            error, self.conn.pool.fail_next = self.conn.pool.fail_next, None
+            self.conn.closed = 1
+            raise error
+        if sql.startswith('SELECT pg_advisory_xact_lock'):
+            self.conn.pool.locks.append(params[0])
+            return
+        assert '?' not in sql, 'placeholders must be translated to %s'
+        self.cursor.execute(sql.replace('%s', '?').replace(' FOR UPDATE', ''), params)
+
+    def executemany(self, sql, rows):
+        for row in rows:
+            self.execute(sql, row)
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+class FakeConnection:
+    def __init__(self, pool):
+        self.pool = pool
+        self.db = sqlite3.connect(pool.path)
+        self.closed = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.db.commit()
+
+    def rollback(self):
+        self.db.rollback()
+
+class FakePool:
+    def __init__(self, path):
+        self.path = path
+        self.idle = []
+        self.statements = []
+        self.locks = []
+        self.discarded = 0
+        self.fail_next = None
+
+    def getconn(self):
+        return self.idle.pop() if self.idle else FakeConnection(self)
+
+    def putconn(self, conn, close=False):
+        if close:
+            conn.db.close()
+            self.discarded += 1
+        else:
+            self.idle.append(conn)
+
+@pytest.fixture
+def pool(tmp_path):
+    return FakePool(str(tmp_path / 'fake.db'))
+
+@pytest.fixture
+def storage(pool):
+    backend = PostgresStorage(pool=pool, batch_size=3, flush_interval=3600)
+    backend.migrate([['CREATE TABLE IF NOT EXISTS user_trends (user_id TEXT PRIMARY KEY, count INTEGER)']])
+    return backend
+
+def test_migrate_translates_placeholders_and_records_version(storage, pool):
+    assert storage.migrate([['CREATE TABLE IF NOT EXISTS user_trends (user_id TEXT PRIMARY KEY, count INTEGER)']]) == 1
+    assert 'INSERT INTO schema_version (version) VALUES (%s)' in pool.statements
+    assert pool.locks == ['schema', 'schema']
+    with storage.transaction() as tx:
+        assert tx.execute('SELECT version FROM schema_version').fetchone() == (1,)
+
+def test_named_transaction_takes_advisory_lock(storage, pool):
+    with storage.transaction(lock='user_trend:u1') as tx:
+        tx.execute('SELECT count FROM user_trends WHERE user_id = ?' + storage.for_update, ('u1',))
+    assert pool.locks[-1] == 'user_trend:u1'
+    assert pool.statements[-1] == 'SELECT count FROM user_trends WHERE user_id = %s FOR UPDATE'
+
+def test_shared_lock_is_taken_before_named_lock(storage, pool):
+    with storage.transaction(lock='user_trend:u1', shared_lock='user_trends'):
+        pass
+    assert pool.locks[-2:] == ['user_trends', 'user_trend:u1']
+    assert 'SELECT pg_advisory_xact_lock_shared(hashtext(%s))' in pool.statements
+
+def test_upsert_updates_existing_row(storage):
+    for count in (1, 2):
+        with storage.transaction() as tx:
+            storage.upsert(tx, 'user_trends', ('user_id',), {'user_id': 'u1', 'count': count})
+    with storage.transaction() as tx:
+        assert tx.execute('SELECT user_id, count FROM user_trends').fetchall() == [('u1', 2)]
+
+def test_events_are_written_in_batches(storage, pool):
+    for number in range(2):
+        storage.record_event((f'e{number}', 'page_view', None, None))
+    with storage.transaction() as tx:
+        assert tx.execute('SELECT COUNT(*) FROM analytics').fetchone() == (0,)
+    storage.record_event(('e2', 'page_view', None, None))
+    inserts = [sql for sql in pool.statements if sql.startswith('INSERT INTO analytics')]
+    assert inserts == ['INSERT INTO analytics (id, event_type, user_id, data) VALUES '
+                       '(%s, %s, %s, %s), (%s, %s, %s, %s), (%s, %s, %s, %s)']
+    with storage.transaction() as tx:
+        assert tx.execute('SELECT COUNT(*) FROM analytics').fetchone() == (3,)
+
+def test_failed_flush_discards_connection_and_requeues_events(storage, pool):
+    storage.record_event(('e0', 'page_view', None, None))
+    pool.fail_next = psycopg2.OperationalError('server closed the connection unexpectedly')
+    with pytest.raises(psycopg2.OperationalError):
+        storage.flush()
+    assert pool.discarded == 1
+    storage.flush()
+    with storage.transaction() as tx:
+        assert tx.execute('SELECT id FROM analytics').fetchall() == [('e0',)]
+
+def test_query_errors_keep_connection_pooled(storage, pool):
+    with pytest.raises(sqlite3.OperationalError):
+        with storage.transaction() as tx:
+            tx.execute('SELECT missing FROM user_trends')
+    assert pool.discarded == 0
+    assert len(pool.idle) == 1